@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+# Building the dataset stores in a single pass: each image (or the bands of
+# a scan time, stacked) is remapped once and both the system-centred arrays
+# (as mask_systems.py) and the random "no convection" arrays (as
+# get_random_g16_samples.py) are cut from the same grid, in a process pool.
+
+import argparse
+import collections
+import configparser
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+
+# Setup SpatiaLite extension
+os.environ["PATH"] = (
+    os.environ["PATH"] + ";../spatialite/mod_spatialite-4.3.0a-win-amd64"
+)
+
+# To use local package
+sys.path.append("../")
+
+from tathu.constants import LAT_LON_WGS84
+from tathu.io import spatialite
+
+import catalog_g16
+import patches
+import remap_g16
+from database import SystemsCache
+from manifest import Manifest
+from patch_store import PatchStore
+
+
+# Data of a system needed by the workers (picklable)
+System = collections.namedtuple(
+    "System", ["name", "raster", "nodata", "geotransform", "centroid"]
+)
+
+
+def pack(systems):
+    """This function converts systems to System tuples."""
+    packed = []
+    for s in systems:
+        c = s.getCentroid()
+        packed.append(
+            System(
+                s.name,
+                s.raster,
+                s.nodata,
+                s.geotransform,
+                (c.GetX(), c.GetY()),
+            )
+        )
+    return packed
+
+
+def extract(
+    files,
+    systems,
+    extent,
+    resolution,
+    lutdir,
+    cachedir,
+    cachesize,
+    sizearray,
+    oversize,
+    samples,
+    counts=False,
+):
+    """
+    This function remaps files (one per band) into a single grid and cuts
+    the arrays centred on each system and the random arrays (away from the
+    systems) from it. If counts, arrays keep the scaled integer counts of
+    the files (see remap_g16.remap_grid).
+
+    Returning system arrays, masks, number of oversize systems, random
+    arrays, their (lon, lat) centers and the {band: (scale, offset)} of
+    counts
+    """
+    grids = [
+        remap_g16.remap_grid(
+            file,
+            extent,
+            resolution,
+            LAT_LON_WGS84,
+            lutdir,
+            cachedir=cachedir,
+            cachesize=cachesize,
+            counts=counts,
+        )
+        for file in files
+    ]
+    scaling = {
+        catalog_g16.get_band(file): (scale, offset)
+        for file, (_, scale, offset) in zip(files, grids)
+    }
+    arrays = [array for array, _, _ in grids]
+    grid = arrays[0] if len(arrays) == 1 else np.stack(arrays, axis=-1)
+    geotransform = remap_g16.get_geotransform(extent, *grid.shape[:2])
+    del arrays, grids
+
+    # System-centred arrays
+    nodata = remap_g16.COUNT_NODATA if counts else remap_g16.NODATA
+    data, masks, count = patches.build_patches(
+        grid, geotransform, systems, sizearray, oversize, nodata
+    )
+
+    # Random arrays
+    boxes = patches.get_boxes(systems, geotransform)
+    lines, cols = patches.sample_windows(grid.shape, sizearray, samples, boxes)
+    random = patches.cut_windows(grid, lines, cols, sizearray)
+    lons = geotransform[0] + geotransform[1] * (cols + sizearray / 2)
+    lats = geotransform[3] + geotransform[5] * (lines + sizearray / 2)
+
+    return data, masks, count, random, list(zip(lons, lats)), scaling
+
+
+def extract_units(units, cache, workers, *args):
+    """
+    This generator extracts the arrays of each unit (timestamp, files),
+    yielding (unit, systems, result) in the same order of units. If workers
+    > 1, units are extracted ahead in a process pool, keeping at most 2 *
+    workers units in progress.
+    """
+    if workers <= 1:
+        for timestamp, files in units:
+            systems = pack(cache.get(timestamp))
+            yield (timestamp, files), systems, extract(files, systems, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        for timestamp, files in units:
+            systems = pack(cache.get(timestamp))
+            future = pool.submit(extract, files, systems, *args)
+            pending.append(((timestamp, files), systems, future))
+            if len(pending) >= 2 * workers:
+                unit, systems, future = pending.popleft()
+                yield unit, systems, future.result()
+        while pending:
+            unit, systems, future = pending.popleft()
+            yield unit, systems, future.result()
+
+
+def main():
+    # Parser line-arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="Config dataset file location",
+        type=str,
+        default="config-dataset.ini",
+    )
+    args = parser.parse_args()
+
+    # Read config file and extract infos
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    pattern = config.get("Dataset", "files")
+    dbname = config.get("Dataset", "database")
+    datadir = config.get("Dataset", "dir")
+    extent = [float(i) for i in config.get("Dataset", "extent").split(",")]
+    resolution = config.getfloat("Dataset", "resolution")
+    lutdir = config.get("Dataset", "lutdir")
+    cachedir = config.get("Dataset", "cachedir", fallback="")
+    cachesize = config.getint("Dataset", "cachesize", fallback=2048)
+    sizearray = config.getint("Dataset", "sizearray")
+    oversize = config.get("Dataset", "oversize")
+    stacked = config.getboolean("Dataset", "stacked")
+    bands = [i.strip() for i in config.get("Dataset", "bands").split(",")]
+    workers = config.getint("Dataset", "workers")
+    dtype = config.get("Dataset", "dtype", fallback="float32")
+    samples = config.getint("Sampling", "samples")
+
+    # Get files, as units of extraction: one file or the bands of a scan
+    # time (sorted, so systems are loaded once per day)
+    files = sorted(glob(pattern))
+    if stacked:
+        units = catalog_g16.group_files(files, bands)
+        shape = (sizearray, sizearray, len(bands))
+        names = ["stacked", "random_stacked"]
+    else:
+        # Timestamped as the C13 file of the scan, as the systems
+        timestamps = catalog_g16.get_timestamps(files)
+        files.sort(key=timestamps.get)
+        units = [(timestamps[file], [file]) for file in files]
+        shape = (sizearray, sizearray)
+        names = ["systems", "random"]
+
+    # Stores, with the same manifests of mask_systems.py and
+    # get_random_g16_samples.py
+    parameters = [
+        {"sizearray": sizearray, "oversize": oversize, "stacked": stacked},
+        {"sizearray": sizearray, "samples": samples, "database": dbname},
+    ]
+    if dtype != "float32":
+        parameters[0]["dtype"] = dtype
+        parameters[1]["dtype"] = dtype
+    if stacked:
+        parameters[0]["bands"] = bands
+        parameters[1]["bands"] = bands
+    stores = []
+    manifests = []
+    pending = []
+    for name, stage, params in zip(names, ["mask", "random"], parameters):
+        store = PatchStore(datadir + name, shape, dtype)
+        manifest = Manifest(store.path, stage, params)
+        if len(store) < manifest.count:
+            manifest.reset()
+        pending.append(set(manifest.get_pending(files, [dbname])))
+        store.truncate(manifest.count)
+        stores.append(store)
+        manifests.append(manifest)
+
+    # Only units with new files
+    units = [
+        (timestamp, group)
+        for timestamp, group in units
+        if pending[0].intersection(group) or pending[1].intersection(group)
+    ]
+
+    # Print infos
+    print("== Dataset ==")
+    print(":: Config dataset file location:", args.config)
+    print(":: Images:", pattern)
+    print(":: Database:", dbname)
+    print(":: Stores:", ", ".join(datadir + name for name in names))
+    print(":: Units to process:", len(units))
+    print(":: Workers:", workers)
+    print(":: Data type:", dtype)
+
+    # Systems of each timestamp
+    cache = SystemsCache(spatialite.Loader(dbname, "systems"))
+
+    results = extract_units(
+        units,
+        cache,
+        workers,
+        extent,
+        resolution,
+        lutdir,
+        cachedir,
+        cachesize,
+        sizearray,
+        oversize,
+        samples,
+        dtype == "uint16",
+    )
+    for (timestamp, group), systems, result in results:
+        data, masks, count, random, centers, scaling = result
+        band = ",".join(catalog_g16.get_band(file) for file in group)
+        file = os.path.basename(group[0])
+
+        if pending[0].intersection(group):
+            stores[0].append(
+                data,
+                masks,
+                [s.name for s in systems],
+                timestamp,
+                band,
+                [s.centroid for s in systems],
+                file,
+                scaling,
+            )
+            manifests[0].add(group, len(stores[0]))
+        if pending[1].intersection(group):
+            stores[1].append(
+                random,
+                timestamp=timestamp,
+                band=band,
+                centroids=centers,
+                file=file,
+                scaling=scaling,
+            )
+            manifests[1].add(group, len(stores[1]))
+
+        print(
+            "Done!",
+            timestamp,
+            band,
+            "-",
+            len(data),
+            "systems,",
+            len(random),
+            "random",
+        )
+        if count:
+            print("Oversize systems (" + oversize + "):", count)
+
+    for name, store, manifest in zip(names, stores, manifests):
+        print("Total of", name, "arrays:", len(store))
+        manifest.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+# Persistent SQLite catalog of a GOES-16 repository (one catalog per
+# repository). Only directories modified since the last update are listed
+# again, and only new files are parsed and inserted.
+
+import datetime
+import os
+import re
+import sqlite3
+
+
+# ABI L2 CMIP full disk file names
+FILENAME = re.compile(
+    r"OR_ABI-L2-CMIPF-M\d(C\d{2})_G16_s(\d{13})\d_e\d{14}_c(\d{13})\d\.nc$"
+)
+
+# Format of timestamps in file names
+FILE_DATE_FORMAT = "%Y%j%H%M%S"
+
+
+def parse(path):
+    """
+    This function parses the band and scan start/creation timestamps of a
+    GOES-16 file name.
+
+    Returning (band, scan start, creation) or None, if it isn't a CMIP file
+    """
+    match = FILENAME.search(os.path.basename(path))
+    if match is None:
+        return None
+    band, start, created = match.groups()
+    start = datetime.datetime.strptime(start, FILE_DATE_FORMAT)
+    created = datetime.datetime.strptime(created, FILE_DATE_FORMAT)
+    return band, start, created
+
+
+def get_timestamp(path):
+    """
+    This function returns the timestamp of a GOES-16 file: its creation
+    time (the _c stamp of the name), as stored in the systems databases.
+    """
+    return parse(path)[2]
+
+
+def get_scan_start(path):
+    """This function returns the scan start of a GOES-16 file."""
+    return parse(path)[1]
+
+
+def get_band(path):
+    """This function returns the band (e.g. C13) of a GOES-16 file."""
+    return parse(path)[0]
+
+
+def get_timestamps(files, tracked="C13"):
+    """
+    This function maps each file to the timestamp of the tracked band file
+    with the same scan start, the one of its systems in the databases
+    (bands of a scan are created at different times). Files of scans
+    without a tracked band file keep their own timestamp.
+
+    Returning a dict {path: timestamp}
+    """
+    references = {}
+    for path in files:
+        band, start, created = parse(path)
+        if band == tracked:
+            references[start] = created
+    return {
+        path: references.get(get_scan_start(path), get_timestamp(path))
+        for path in files
+    }
+
+
+def group_files(files, bands, tracked="C13"):
+    """
+    This function groups files by scan start, keeping only scan starts with
+    a file of every band. Groups are timestamped as the file of the tracked
+    band (or of the first band, if it isn't one of bands), matching the
+    systems tracked on that band.
+
+    Returning a list of (timestamp, [path of each band]), ordered by scan
+    start
+    """
+    groups = {}
+    for path in files:
+        band, start, _ = parse(path)
+        if band in bands:
+            groups.setdefault(start, {})[band] = path
+
+    reference = tracked if tracked in bands else bands[0]
+    result = []
+    for start in sorted(groups):
+        if len(groups[start]) < len(bands):
+            print("* Skipping incomplete scan:", start)
+            continue
+        result.append(
+            (
+                get_timestamp(groups[start][reference]),
+                [groups[start][band] for band in bands],
+            )
+        )
+    return result
+
+
+def connect(path):
+    """This function opens (creating, if necessary) a catalog."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, directory TEXT, band TEXT, scan_start TEXT, "
+        "created TEXT, size INTEGER, mtime REAL)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS files_band_created "
+        "ON files (band, created)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS files_directory ON files (directory)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS directories ("
+        "path TEXT PRIMARY KEY, parent TEXT, mtime REAL)"
+    )
+    conn.commit()
+    return conn
+
+
+def update(conn, repository):
+    """
+    This function updates the catalog with the files of repository (and
+    its subdirectories), listing only directories modified since the last
+    update.
+
+    Returning the number of new files
+    """
+    count = 0
+    stack = [os.path.normpath(repository)]
+    while stack:
+        directory = stack.pop()
+        mtime = os.stat(directory).st_mtime
+        row = conn.execute(
+            "SELECT mtime FROM directories WHERE path = ?", (directory,)
+        ).fetchone()
+
+        # Unchanged: visit known subdirectories only
+        if row is not None and row[0] == mtime:
+            stack.extend(
+                path
+                for path, in conn.execute(
+                    "SELECT path FROM directories WHERE parent = ?",
+                    (directory,),
+                )
+            )
+            continue
+
+        known = set(
+            path
+            for path, in conn.execute(
+                "SELECT path FROM files WHERE directory = ?", (directory,)
+            )
+        )
+        found = set()
+        subdirectories = set()
+        rows = []
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                stack.append(entry.path)
+                subdirectories.add(entry.path)
+                conn.execute(
+                    "INSERT OR IGNORE INTO directories VALUES (?, ?, NULL)",
+                    (entry.path, directory),
+                )
+                continue
+            info = parse(entry.name)
+            if info is None:
+                continue
+            found.add(entry.path)
+            if entry.path in known:
+                continue
+            band, start, created = info
+            stat = entry.stat()
+            rows.append(
+                (
+                    entry.path,
+                    directory,
+                    band,
+                    str(start),
+                    str(created),
+                    stat.st_size,
+                    stat.st_mtime,
+                )
+            )
+
+        conn.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        conn.executemany(
+            "DELETE FROM files WHERE path = ?",
+            [(path,) for path in known - found],
+        )
+
+        # Forget removed subdirectories (and everything below them)
+        for path, in conn.execute(
+            "SELECT path FROM directories WHERE parent = ?", (directory,)
+        ).fetchall():
+            if path not in subdirectories:
+                prefix = os.path.join(path, "") + "%"
+                conn.execute(
+                    "DELETE FROM files "
+                    "WHERE directory = ? OR directory LIKE ?",
+                    (path, prefix),
+                )
+                conn.execute(
+                    "DELETE FROM directories WHERE path = ? OR path LIKE ?",
+                    (path, prefix),
+                )
+        conn.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, "
+            "(SELECT parent FROM directories WHERE path = ?), ?)",
+            (directory, directory, mtime),
+        )
+        conn.commit()
+        count += len(rows)
+
+    return count
+
+
+def query(conn, start=None, end=None, band=None):
+    """
+    This function returns (path, timestamp) of catalog files, ordered by
+    timestamp (creation time, see get_timestamp), optionally filtered by
+    band and timestamp in [start, end).
+    """
+    sql = "SELECT path, created FROM files WHERE 1"
+    params = []
+    if start is not None:
+        sql += " AND created >= ?"
+        params.append(str(start))
+    if end is not None:
+        sql += " AND created < ?"
+        params.append(str(end))
+    if band is not None:
+        sql += " AND band = ?"
+        params.append(band)
+    sql += " ORDER BY created, path"
+
+    return [
+        (path, datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S"))
+        for path, timestamp in conn.execute(sql, params)
+    ]
+
+
+def get_files(conn, start=None, end=None, band=None):
+    """This function returns the paths of catalog files (see query)."""
+    return [path for path, _ in query(conn, start, end, band)]
+
+
+def get_gaps(conn, start, end, band, timeout):
+    """
+    This function returns the (previous, next) timestamps of consecutive
+    files separated by more than timeout minutes.
+    """
+    rows = query(conn, start, end, band)
+    return [
+        (previous, current)
+        for (_, previous), (_, current) in zip(rows, rows[1:])
+        if (current - previous).total_seconds() > timeout * 60
+    ]
+
+
+def get_periods(conn, start, end, band, timeout):
+    """
+    This function splits the files into periods without gaps greater than
+    timeout minutes.
+
+    Returning a list of lists of paths
+    """
+    periods = []
+    previous = None
+    for path, current in query(conn, start, end, band):
+        if (
+            previous is None
+            or (current - previous).total_seconds() > timeout * 60
+        ):
+            periods.append([])
+        periods[-1].append(path)
+        previous = current
+    return periods
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Checking the coarse-to-fine detector (detector = coarse) against the
+# whole-grid labelling (detector = label) on real images: both must give
+# the same systems, except the ones detect_coarse is allowed to miss
+# (containing no coarse pixel)
+
+import argparse
+import configparser
+import sys
+import time
+from glob import glob
+
+import numpy as np
+
+from tathu.constants import KM_PER_DEGREE, LAT_LON_WGS84
+
+import detection
+import remap_g16
+
+
+def get_origin(s, geotransform):
+    """
+    This function returns the (line, column) of the system raster origin
+    in a grid.
+    """
+    gt = s.geotransform
+    line = int(round((gt[3] - geotransform[3]) / geotransform[5]))
+    col = int(round((gt[0] - geotransform[0]) / geotransform[1]))
+    return line, col
+
+
+def get_key(s, geotransform):
+    """
+    This function returns the pixels of a system (raster origin in the grid
+    and raster), which identify it. Coordinates are not compared, they may
+    differ by rounding.
+    """
+    return get_origin(s, geotransform) + (s.raster.shape, s.raster.tobytes())
+
+
+def has_coarse_pixel(s, geotransform, step):
+    """
+    This function tests if a system contains a pixel of the coarse grid of
+    detect_coarse (one every step lines and columns).
+    """
+    line, col = get_origin(s, geotransform)
+    lines, cols = np.nonzero(s.raster != s.nodata)
+    first = step // 2
+    sampled = ((line + lines - first) % step == 0) & (
+        (col + cols - first) % step == 0
+    )
+    return bool(sampled.any())
+
+
+def compare(path, extent, resolution, lutdir, args):
+    """
+    This function detects the systems of an image with both detectors.
+
+    Returning the number of systems of each one, the number of systems
+    missed within the tolerance, the list of unexpected differences and
+    the detection times (seconds)
+    """
+    data, index = remap_g16.read_source(
+        path, extent, resolution, LAT_LON_WGS84, lutdir
+    )
+    geotransform = remap_g16.get_geotransform(extent, *index.shape)
+
+    begin = time.perf_counter()
+    grid = remap_g16.apply_lut(data, index)
+    full = detection.detect_array(
+        grid, geotransform, remap_g16.NODATA, *args
+    )
+    elapsed = [time.perf_counter() - begin]
+
+    begin = time.perf_counter()
+    coarse = detection.detect_coarse(data, index, geotransform, *args)
+    elapsed.append(time.perf_counter() - begin)
+
+    systems = {get_key(s, geotransform): s for s in coarse}
+    missed = 0
+    errors = []
+    for s in full:
+        other = systems.pop(get_key(s, geotransform), None)
+        if other is None:
+            if has_coarse_pixel(s, geotransform, detection.COARSE_STEP):
+                errors.append("missed system " + str(s.attrs))
+            else:
+                missed += 1
+            continue
+        for key, value in s.attrs.items():
+            if not np.isclose(value, other.attrs.get(key, np.nan)):
+                errors.append(
+                    "different " + key + ": " + str(value) + " != "
+                    + str(other.attrs.get(key))
+                )
+        if abs(s.geom.GetArea() - other.geom.GetArea()) > 1e-9:
+            errors.append("different geometry " + str(s.attrs))
+    for s in systems.values():
+        errors.append("extra system " + str(s.attrs))
+
+    return len(full), len(coarse), missed, errors, elapsed
+
+
+def main():
+    # Parser line-arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-c",
+        "--config",
+        help="Config tracking file location",
+        default="config-g16.ini",
+    )
+    parser.add_argument("files", help="Images (glob patterns)", nargs="+")
+    args = parser.parse_args()
+
+    # Read config file (as tracking_g16.py)
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    extent = [float(i) for i in config.get("Grid", "extent").split(",")]
+    resolution = float(config.get("Grid", "resolution"))
+    lutdir = config.get("Grid", "lutdir")
+    threshold = float(config.get("TrackingParameters", "threshold"))
+    minarea = float(config.get("TrackingParameters", "minarea"))
+    stats = [i for i in config.get("TrackingParameters", "stats").split(",")]
+    compute_cc = config.getboolean("TrackingParameters", "compute_cc")
+    threshold_cc = float(config.get("TrackingParameters", "threshold_cc"))
+    minarea_cc = float(config.get("TrackingParameters", "minarea_cc"))
+    parameters = (
+        threshold,
+        minarea / (KM_PER_DEGREE * KM_PER_DEGREE),
+        stats,
+        compute_cc,
+        threshold_cc,
+        minarea_cc / (KM_PER_DEGREE * KM_PER_DEGREE),
+    )
+
+    files = sorted(path for pattern in args.files for path in glob(pattern))
+    failed = 0
+    for path in files:
+        nfull, ncoarse, missed, errors, elapsed = compare(
+            path, extent, resolution, lutdir, parameters
+        )
+        print(
+            path,
+            "- label:",
+            nfull,
+            "systems in %.2f s," % elapsed[0],
+            "coarse:",
+            ncoarse,
+            "systems in %.2f s," % elapsed[1],
+            "missed within tolerance:",
+            missed,
+        )
+        for error in errors:
+            print("*", error)
+        failed += bool(errors)
+
+    print("Images:", len(files), "- with unexpected differences:", failed)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+# Helpers to work directly on the SpatiaLite databases written by
+# tathu.io.spatialite.Outputter
+
+import collections
+import sqlite3
+
+
+# Columns of the systems table used here
+NAME = "name"
+TIMESTAMP = "date_time"
+RELATIONSHIPS = "relationships"
+
+# Expression comparing timestamps as str(datetime)
+DATE_FORMAT = "strftime('%Y-%m-%d %H:%M:%S', {d})"
+
+
+def connect(path):
+    """This function opens a database with the SpatiaLite extension."""
+    conn = sqlite3.connect(path)
+    conn.enable_load_extension(True)
+    conn.load_extension("mod_spatialite")
+    return conn
+
+
+def get_columns(conn, table, schema="main"):
+    """This function returns the column names of a table."""
+    query = "PRAGMA " + schema + ".table_info(" + table + ")"
+    return [row[1] for row in conn.execute(query)]
+
+
+def stitch(conn, table, timestamp, schema="shard"):
+    """
+    This function matches the systems of the overlap image (timestamp, as
+    str(datetime)) of an attached shard with the same systems of the main
+    database, which are identical since both come from the same image.
+
+    Returning a dict {shard name: main name}
+    """
+    query = "SELECT {n}, geom FROM {s}.{t} WHERE " + DATE_FORMAT + " = ?"
+    main = conn.execute(
+        query.format(n=NAME, s="main", t=table, d=TIMESTAMP), (timestamp,)
+    )
+    names = {bytes(geom): name for name, geom in main}
+
+    mapping = {}
+    shard = conn.execute(
+        query.format(n=NAME, s=schema, t=table, d=TIMESTAMP), (timestamp,)
+    )
+    for name, geom in shard:
+        if bytes(geom) in names:
+            mapping[name] = names[bytes(geom)]
+        else:
+            print("* Unmatched system at shard boundary:", name, timestamp)
+
+    return mapping
+
+
+def rename(conn, table, mapping, rowid):
+    """
+    This function renames systems (and their relationships) inserted after
+    the given rowid, according to mapping.
+    """
+    conn.execute("DROP TABLE IF EXISTS temp.stitch")
+    conn.execute("CREATE TEMP TABLE stitch (old TEXT PRIMARY KEY, new TEXT)")
+    conn.executemany("INSERT INTO temp.stitch VALUES (?, ?)", mapping.items())
+    conn.execute(
+        "UPDATE {t} SET {n} = (SELECT new FROM temp.stitch WHERE old = {n}) "
+        "WHERE rowid > ? AND {n} IN (SELECT old FROM temp.stitch)".format(
+            t=table, n=NAME
+        ),
+        (rowid,),
+    )
+
+    if RELATIONSHIPS not in get_columns(conn, table):
+        return
+
+    for old, new in mapping.items():
+        conn.execute(
+            "UPDATE {t} SET {r} = REPLACE({r}, ?, ?) "
+            "WHERE rowid > ? AND {r} LIKE ?".format(t=table, r=RELATIONSHIPS),
+            (old, new, rowid, "%" + old + "%"),
+        )
+
+
+def copy_checkpoints(conn, schema="shard"):
+    """
+    This function copies the checkpoints of an attached shard, so the last
+    checkpoint of the merged database is the last image of all shards.
+    """
+    tables = conn.execute(
+        "SELECT name FROM " + schema + ".sqlite_master "
+        "WHERE type = 'table' AND name = 'checkpoints'"
+    ).fetchall()
+    if not tables:
+        return
+    create_checkpoints(conn)
+    conn.execute(
+        "INSERT OR REPLACE INTO checkpoints "
+        "SELECT period, timestamp FROM " + schema + ".checkpoints"
+    )
+
+
+def merge_shards(shards, overlaps, database, table="systems", stats=None):
+    """
+    This function merges the databases of consecutive time shards into
+    database. Shards with an overlap timestamp start with the last image of
+    the previous shard: that image is dropped and the families found there
+    keep the names given by the previous shard, as in a serial run. The
+    checkpoints of all shards are kept, so a resume of the merged database
+    starts after the last image of the last shard. If the stat columns are
+    given, the families table is rebuilt afterwards.
+    """
+    # Copied through SQLite, so pending WAL contents are included
+    conn = connect(database)
+    source = sqlite3.connect(shards[0])
+    source.backup(conn)
+    source.close()
+    columns = ", ".join(get_columns(conn, table))
+
+    for path, overlap in zip(shards[1:], overlaps[1:]):
+        print("Merging shard", path)
+        conn.execute("ATTACH DATABASE ? AS shard", (path,))
+
+        # Last row before merging this shard
+        rowid = conn.execute("SELECT MAX(rowid) FROM " + table).fetchone()[0]
+        rowid = rowid or 0
+
+        query = "INSERT INTO {t} ({c}) SELECT {c} FROM shard.{t}".format(
+            t=table, c=columns
+        )
+        params = ()
+        mapping = {}
+        if overlap is not None:
+            mapping = stitch(conn, table, str(overlap))
+            query += " WHERE " + DATE_FORMAT.format(d=TIMESTAMP) + " > ?"
+            params = (str(overlap),)
+        conn.execute(query + " ORDER BY rowid", params)
+
+        rename(conn, table, mapping, rowid)
+        copy_checkpoints(conn)
+        conn.commit()
+        conn.execute("DETACH DATABASE shard")
+
+    # The state of shard 0 (e.g. its families rows) doesn't hold anymore
+    conn.execute("DROP TABLE IF EXISTS tracker_state")
+    conn.execute("DROP TABLE IF EXISTS families")
+    conn.commit()
+    if stats is not None:
+        print("Rebuilding families table")
+        rebuild_families(conn, stats, table)
+
+    conn.close()
+
+
+def save_state(conn, **state):
+    """This function saves key/values of the tracker state."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tracker_state "
+        "(key TEXT PRIMARY KEY, value TEXT)"
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO tracker_state VALUES (?, ?)",
+        [(key, str(value)) for key, value in state.items()],
+    )
+    conn.commit()
+
+
+def load_state(conn):
+    """This function returns the tracker state saved by save_state()."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tracker_state "
+        "(key TEXT PRIMARY KEY, value TEXT)"
+    )
+    return dict(conn.execute("SELECT key, value FROM tracker_state"))
+
+
+def get_last_timestamp(conn, table="systems"):
+    """
+    This function returns the last timestamp (as str(datetime)) of a table,
+    or None if it is empty or doesn't exist.
+    """
+    try:
+        query = "SELECT MAX(" + DATE_FORMAT + ") FROM {t}"
+        row = conn.execute(query.format(d=TIMESTAMP, t=table)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0]
+
+
+def create_checkpoints(conn):
+    """This function creates the checkpoints table (if needed)."""
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS checkpoints "
+        "(period TEXT PRIMARY KEY, timestamp TEXT)"
+    )
+
+
+def save_checkpoint(conn, period, timestamp):
+    """
+    This function records timestamp as the last image of period (both as
+    str(datetime)) successfully written.
+    """
+    create_checkpoints(conn)
+    conn.execute(
+        "INSERT OR REPLACE INTO checkpoints VALUES (?, ?)",
+        (str(period), str(timestamp)),
+    )
+    conn.commit()
+
+
+def get_last_checkpoint(conn):
+    """
+    This function returns the last checkpoint timestamp (as str(datetime))
+    or None, if there is none.
+    """
+    create_checkpoints(conn)
+    return conn.execute("SELECT MAX(timestamp) FROM checkpoints").fetchone()[0]
+
+
+def discard_unchecked(conn, columns, table="systems"):
+    """
+    This function deletes the systems written after the last checkpoint
+    (systems and checkpoints are committed separately, so a crash may leave
+    some behind), rebuilding the families table if there were any.
+
+    Returning the last checkpoint or, for older databases without them, the
+    last timestamp (None, if the database is empty)
+    """
+    timestamp = get_last_checkpoint(conn)
+    if timestamp is None:
+        return get_last_timestamp(conn, table)
+
+    query = "DELETE FROM {t} WHERE " + DATE_FORMAT + " > ?"
+    cursor = conn.execute(query.format(t=table, d=TIMESTAMP), (timestamp,))
+    conn.commit()
+    if cursor.rowcount > 0:
+        print("Discarded systems after the last checkpoint:", cursor.rowcount)
+        rebuild_families(conn, columns, table)
+    return timestamp
+
+
+def create_families(conn, columns, table="systems"):
+    """
+    This function creates the families summary table (if needed), with the
+    min/max of each stat column (e.g. count_min, count_max), and the
+    indexes on the timestamp and family name of the systems table.
+    """
+    extrema = "".join(
+        ', "{c}_min" REAL, "{c}_max" REAL'.format(c=c) for c in columns
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS families ("
+        "name TEXT PRIMARY KEY, first TEXT, last TEXT, frames INTEGER"
+        + extrema
+        + ", genesis_lon REAL, genesis_lat REAL"
+        ", lysis_lon REAL, lysis_lat REAL)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS families_first ON families (first)"
+    )
+    for column in (TIMESTAMP, NAME):
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS {t}_{c} ON {t} ({c})".format(
+                t=table, c=column
+            )
+        )
+
+
+def update_families(conn, columns, table="systems"):
+    """
+    This function folds the systems written since the last update (by
+    rowid, saved as the families key of the tracker state) into the
+    families table: first/last timestamp (as str(datetime)), number of
+    frames, min/max of the given stat columns and genesis/lysis centroids.
+    """
+    create_families(conn, columns, table)
+    rowid = int(load_state(conn).get("families", 0))
+    last = conn.execute("SELECT MAX(rowid) FROM " + table).fetchone()[0]
+    if last is None or last <= rowid:
+        return
+
+    end = (
+        "(SELECT e.rowid FROM {t} AS e WHERE e.{n} = s.{n} "
+        "AND e.rowid > :rowid AND e.rowid <= :last "
+        "ORDER BY e.{d} {o}, e.rowid {o} LIMIT 1)"
+    )
+    aggregates = "".join(
+        ', MIN("{c}") AS "{c}_min", MAX("{c}") AS "{c}_max"'.format(c=c)
+        for c in columns
+    )
+    extrema = "".join(
+        ', b."{c}_min", b."{c}_max"'.format(c=c) for c in columns
+    )
+    updates = "".join(
+        ', "{c}_{f}" = {f}(COALESCE("{c}_{f}", excluded."{c}_{f}"), '
+        'COALESCE(excluded."{c}_{f}", "{c}_{f}"))'.format(c=c, f=f)
+        for c in columns
+        for f in ("min", "max")
+    )
+    query = (
+        "WITH batch AS ("
+        "SELECT s.{n} AS name, MIN({ts}) AS first, MAX({ts}) AS last, "
+        "COUNT(DISTINCT {ts}) AS frames" + aggregates + ", "
+        + end.format(t=table, n=NAME, d=TIMESTAMP, o="ASC")
+        + " AS genesis, "
+        + end.format(t=table, n=NAME, d=TIMESTAMP, o="DESC")
+        + " AS lysis "
+        "FROM {t} AS s WHERE s.rowid > :rowid AND s.rowid <= :last "
+        "GROUP BY s.{n}) "
+        "INSERT INTO families "
+        "SELECT b.name, b.first, b.last, b.frames" + extrema + ", "
+        "X(Centroid(g.geom)), Y(Centroid(g.geom)), "
+        "X(Centroid(l.geom)), Y(Centroid(l.geom)) "
+        "FROM batch AS b "
+        "JOIN {t} AS g ON g.rowid = b.genesis "
+        "JOIN {t} AS l ON l.rowid = b.lysis WHERE 1 "
+        "ON CONFLICT (name) DO UPDATE SET "
+        "genesis_lon = CASE WHEN excluded.first < first "
+        "THEN excluded.genesis_lon ELSE genesis_lon END, "
+        "genesis_lat = CASE WHEN excluded.first < first "
+        "THEN excluded.genesis_lat ELSE genesis_lat END, "
+        "lysis_lon = CASE WHEN excluded.last >= last "
+        "THEN excluded.lysis_lon ELSE lysis_lon END, "
+        "lysis_lat = CASE WHEN excluded.last >= last "
+        "THEN excluded.lysis_lat ELSE lysis_lat END, "
+        "first = MIN(first, excluded.first), "
+        "last = MAX(last, excluded.last), "
+        "frames = frames + excluded.frames" + updates
+    ).format(t=table, n=NAME, ts=DATE_FORMAT.format(d="s." + TIMESTAMP))
+    conn.execute(query, {"rowid": rowid, "last": last})
+
+    # Committed together with the families rows
+    save_state(conn, families=last)
+
+
+def rebuild_families(conn, columns, table="systems"):
+    """
+    This function computes the families table again from all systems (e.g.
+    after renaming the families of merged shards).
+    """
+    conn.execute("DROP TABLE IF EXISTS families")
+    save_state(conn, families=0)
+    update_families(conn, columns, table)
+
+
+def iter_rows(conn, query, params=(), chunksize=10000):
+    """
+    This generator runs query in a single cursor pass, yielding lists of
+    up to chunksize rows.
+    """
+    cursor = conn.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        yield rows
+    cursor.close()
+
+
+class SystemsCache(object):
+    """
+    This class serves the systems of a timestamp from an in-memory index,
+    loading the systems (with rasters) of a whole day at once through a
+    spatialite.Loader, instead of querying the database for each file. The
+    last maxdays days are kept in memory.
+    """
+
+    def __init__(self, loader, maxdays=2):
+        self.loader = loader
+        self.maxdays = maxdays
+        # {day: {str(timestamp): systems}}, in access order
+        self.days = collections.OrderedDict()
+
+    def load(self, day):
+        """This method indexes the systems of day (yyyy-mm-dd)."""
+        index = collections.defaultdict(list)
+        for s in self.loader.loadByDate("%Y-%m-%d", day, []):
+            index[str(s.timestamp)].append(s)
+        return index
+
+    def get(self, timestamp):
+        """This method returns the systems of timestamp (a datetime)."""
+        day = timestamp.strftime("%Y-%m-%d")
+        if day in self.days:
+            self.days.move_to_end(day)
+        else:
+            print("Loading systems of", day)
+            self.days[day] = self.load(day)
+            if len(self.days) > self.maxdays:
+                self.days.popitem(last=False)
+        return self.days[day].get(str(timestamp), [])
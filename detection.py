@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+# Raster-label detection of convective systems. The thresholded grid is
+# labelled once (connected components), systems are filtered by pixel
+# counts and the statistics of all of them are computed together; only the
+# accepted systems are converted to polygons. The coarse-to-fine variant
+# remaps and labels only the regions of the grid where a coarse grid shows
+# cold pixels.
+
+import numpy as np
+from osgeo import gdal, ogr
+from scipy import ndimage
+
+from tathu.constants import LAT_LON_WGS84
+from tathu.tracking.system import ConvectiveSystem
+
+from remap_g16 import NODATA, apply_lut
+
+
+# Coarse grid pixel size (in grid pixels) of detect_coarse
+COARSE_STEP = 4
+
+# Margin (Kelvin) added to the threshold on the coarse grid
+COARSE_MARGIN = 5.0
+
+# Coarse pixels added around the candidate regions
+COARSE_DILATION = 1
+
+# Coarse pixels added to the regions crossed by a system
+COARSE_GROWTH = 8
+
+# Per-label reductions available as system stats
+STATS = {
+    "min": ndimage.minimum,
+    "max": ndimage.maximum,
+    "mean": ndimage.mean,
+    "std": ndimage.standard_deviation,
+    "median": ndimage.median,
+    "count": lambda array, labels, ids: np.bincount(labels.ravel())[ids],
+}
+
+
+def label(array, valid, threshold, minarea, geotransform):
+    """
+    This function labels the connected regions of valid pixels below
+    threshold (4-connected, as GDAL polygonize).
+
+    Returning the labels array and the ids with area >= minarea (degrees^2)
+    """
+    labels, n = ndimage.label(valid & (array < threshold))
+    counts = np.bincount(labels.ravel(), minlength=n + 1)
+    pixelarea = abs(geotransform[1] * geotransform[5])
+    ids = np.flatnonzero(counts * pixelarea >= minarea)
+    return labels, ids[ids > 0]
+
+
+def count_cells(
+    array, valid, labels, ids, threshold_cc, minarea_cc, geotransform
+):
+    """
+    This function counts the convective cells (regions below threshold_cc
+    with area >= minarea_cc) inside each labelled system.
+    """
+    cells, cellids = label(
+        array, valid, threshold_cc, minarea_cc, geotransform
+    )
+    if cellids.size == 0:
+        return np.zeros(ids.size, dtype=np.int64)
+    # Cells are colder than systems, so each one lies in a single system
+    parents = ndimage.maximum(labels, cells, cellids).astype(np.int64)
+    return np.bincount(parents, minlength=labels.max() + 1)[ids]
+
+
+def polygonize(labels, ids, geotransform):
+    """
+    This function converts the given labels to polygons.
+
+    Returning a dict {label: geometry}
+    """
+    kept = np.zeros(labels.max() + 1, dtype=np.int32)
+    kept[ids] = ids
+    kept = kept[labels]
+
+    # Raster of kept labels
+    memDriver = gdal.GetDriverByName("MEM")
+    raster = memDriver.Create(
+        "labels", kept.shape[1], kept.shape[0], 1, gdal.GDT_Int32
+    )
+    raster.SetGeoTransform(geotransform)
+    raster.SetProjection(LAT_LON_WGS84.ExportToWkt())
+    band = raster.GetRasterBand(1)
+    band.WriteArray(kept)
+
+    # Vector layer that receives the polygons
+    source = ogr.GetDriverByName("Memory").CreateDataSource("polygons")
+    layer = source.CreateLayer("polygons", LAT_LON_WGS84, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn("label", ogr.OFTInteger))
+
+    # Zero (discarded) pixels are masked out by the band itself
+    gdal.Polygonize(band, band, layer, 0, [], callback=None)
+
+    geoms = {}
+    for feature in layer:
+        geom = feature.GetGeometryRef().Clone()
+        geom.AssignSpatialReference(LAT_LON_WGS84)
+        geoms[feature.GetField("label")] = geom
+
+    return geoms
+
+
+def detect_array(
+    array,
+    geotransform,
+    nodata,
+    threshold,
+    minarea,
+    stats,
+    compute_cc,
+    threshold_cc,
+    minarea_cc,
+):
+    """
+    This function detects systems below threshold on the given array,
+    describing them as StatisticalDescriptor(stats, rasterOut=True) and
+    ConvectiveCellsDescriptor do.
+
+    Returning a list of systems
+    """
+    valid = np.isfinite(array)
+    if nodata is not None:
+        valid &= array != nodata
+    else:
+        nodata = np.nan
+
+    # Label and filter systems by area
+    labels, ids = label(array, valid, threshold, minarea, geotransform)
+    if ids.size == 0:
+        return []
+
+    # Stats of all systems at once
+    values = {}
+    for stat in stats:
+        if stat not in STATS:
+            raise ValueError("Unsupported stat: " + stat)
+        values[stat] = np.asarray(STATS[stat](array, labels, ids))
+
+    if compute_cc:
+        values["ncells"] = count_cells(
+            array, valid, labels, ids, threshold_cc, minarea_cc, geotransform
+        )
+
+    # Polygons of accepted systems only
+    geoms = polygonize(labels, ids, geotransform)
+
+    # Bounding boxes (slices) of each label
+    boxes = ndimage.find_objects(labels)
+
+    systems = []
+    for i, k in enumerate(ids):
+        s = ConvectiveSystem(geoms[k])
+        for key, value in values.items():
+            s.attrs[key] = value[i].item()
+
+        # System raster: values inside the system, nodata elsewhere
+        lines, cols = boxes[k - 1]
+        raster = array[lines, cols].copy()
+        raster[labels[lines, cols] != k] = nodata
+        s.raster = raster
+        s.nodata = nodata
+        s.geotransform = [
+            geotransform[0] + cols.start * geotransform[1],
+            geotransform[1],
+            0.0,
+            geotransform[3] + lines.start * geotransform[5],
+            0.0,
+            geotransform[5],
+        ]
+
+        systems.append(s)
+
+    return systems
+
+
+def detect(
+    grid, threshold, minarea, stats, compute_cc, threshold_cc, minarea_cc
+):
+    """This function detects systems on a GDAL grid (see detect_array)."""
+    return detect_array(
+        grid.ReadAsArray(),
+        grid.GetGeoTransform(),
+        grid.GetRasterBand(1).GetNoDataValue(),
+        threshold,
+        minarea,
+        stats,
+        compute_cc,
+        threshold_cc,
+        minarea_cc,
+    )
+
+
+def merge_boxes(boxes):
+    """
+    This function merges overlapping boxes ([line0, line1, col0, col1],
+    end excluded) until all of them are disjoint. Boxes are swept by first
+    line, each one merged into the first open box (not ended before it)
+    that it overlaps; sweeps are repeated while merges happen, since a
+    merged box may reach other boxes.
+    """
+    boxes = sorted(list(box) for box in boxes)
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        opened = []
+        for box in boxes:
+            opened = [other for other in opened if other[1] > box[0]]
+            for other in opened:
+                if other[2] < box[3] and box[2] < other[3]:
+                    other[1] = max(other[1], box[1])
+                    other[2] = min(other[2], box[2])
+                    other[3] = max(other[3], box[3])
+                    merged = True
+                    break
+            else:
+                opened.append(box)
+                result.append(box)
+        boxes = sorted(result)
+    return boxes
+
+
+def get_regions(data, index, threshold, step, margin, dilation):
+    """
+    This function finds the candidate regions of a grid (given by the
+    source data and its LUT, see remap_g16.read_source) on a coarse grid
+    made of one pixel every step pixels: pixels below threshold + margin,
+    dilated by dilation coarse pixels.
+
+    Returning the boxes ([line0, line1, col0, col1]) of the regions on the
+    full resolution grid
+    """
+    first = step // 2
+    coarse = apply_lut(data, index[first::step, first::step])
+    candidates = (coarse != NODATA) & (coarse < threshold + margin)
+    if dilation > 0:
+        candidates = ndimage.binary_dilation(candidates, iterations=dilation)
+    labels, _ = ndimage.label(candidates)
+
+    nlines, ncols = index.shape
+    boxes = []
+    for lines, cols in ndimage.find_objects(labels):
+        boxes.append(
+            [
+                max(lines.start * step + first - step, 0),
+                min(lines.stop * step + first + step, nlines),
+                max(cols.start * step + first - step, 0),
+                min(cols.stop * step + first + step, ncols),
+            ]
+        )
+    return merge_boxes(boxes)
+
+
+def get_sides(data, index, box, threshold):
+    """
+    This function tests the borders (first/last line, first/last column)
+    of a region for pixels below threshold, gathering only those pixels.
+
+    Returning a list of 4 flags, as box
+    """
+    line0, line1, col0, col1 = box
+    borders = (
+        index[line0, col0:col1],
+        index[line1 - 1, col0:col1],
+        index[line0:line1, col0],
+        index[line0:line1, col1 - 1],
+    )
+    sides = []
+    for border in borders:
+        values = apply_lut(data, border)
+        sides.append(bool(((values != NODATA) & (values < threshold)).any()))
+    return sides
+
+
+def grow_regions(data, index, boxes, threshold, growth):
+    """
+    This function grows the regions whose borders (inside the grid) have
+    pixels below threshold by growth pixels on those sides, merging them,
+    until all systems lie entirely inside a single region. Only regions
+    grown or merged in the previous round are tested again.
+    """
+    limits = (0, index.shape[0], 0, index.shape[1])
+    boxes = merge_boxes(boxes)
+    active = boxes
+    while active:
+        grown = set()
+        for box in active:
+            old = tuple(box)
+            sides = get_sides(data, index, box, threshold)
+            for side, cold in enumerate(sides):
+                if cold and box[side] != limits[side]:
+                    delta = growth if side % 2 else -growth
+                    box[side] = min(
+                        max(box[side] + delta, 0), limits[side | 1]
+                    )
+            if tuple(box) != old:
+                grown.add(id(box))
+        if not grown:
+            break
+        stable = set(tuple(box) for box in boxes if id(box) not in grown)
+        boxes = merge_boxes(boxes)
+        active = [box for box in boxes if tuple(box) not in stable]
+    return boxes
+
+
+def detect_coarse(
+    data,
+    index,
+    geotransform,
+    threshold,
+    minarea,
+    stats,
+    compute_cc,
+    threshold_cc,
+    minarea_cc,
+    step=COARSE_STEP,
+    margin=COARSE_MARGIN,
+    dilation=COARSE_DILATION,
+    growth=COARSE_GROWTH,
+):
+    """
+    This function detects systems as detect_array does on the whole grid
+    (given by the source data and its LUT, see remap_g16.read_source),
+    remapping and analysing at full resolution only the candidate regions
+    found on a coarse grid (see get_regions), grown until no system crosses
+    their borders (see grow_regions).
+
+    Systems are the same of detect_array (geometry, stats, cells and
+    raster), except systems without coarse pixels below threshold + margin
+    around them, which are missed. Since system pixels are below threshold,
+    only systems containing no coarse pixel (one every step lines and
+    columns) can be missed, i.e. tiny or thin systems fitting between the
+    coarse lines or columns, far smaller than the usual minarea. See
+    compare_detectors.py to check it on real images.
+
+    Returning a list of systems
+    """
+    boxes = get_regions(data, index, threshold, step, margin, dilation)
+    boxes = grow_regions(data, index, boxes, threshold, growth * step)
+
+    systems = []
+    for line0, line1, col0, col1 in boxes:
+        array = apply_lut(data, index[line0:line1, col0:col1])
+        systems.extend(
+            detect_array(
+                array,
+                [
+                    geotransform[0] + col0 * geotransform[1],
+                    geotransform[1],
+                    0.0,
+                    geotransform[3] + line0 * geotransform[5],
+                    0.0,
+                    geotransform[5],
+                ],
+                NODATA,
+                threshold,
+                minarea,
+                stats,
+                compute_cc,
+                threshold_cc,
+                minarea_cc,
+            )
+        )
+    return systems
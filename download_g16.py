@@ -1,24 +1,157 @@
+import argparse
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-import pandas as pd
 
-from utilities import download_CMI
+import boto3
+from botocore import UNSIGNED
+from botocore.config import Config
 
-# Defining data path
-data_path = "data_in/g16"
-os.makedirs(data_path, exist_ok=True)
 
 # AMAZON repository information
 # https://noaa-goes16.s3.amazonaws.com/index.html
-bucket_name = "noaa-goes16"
-product_name = "ABI-L2-CMIPF"
-dates = pd.date_range(
-    datetime(2020, 1, 12, 0, 0), datetime(2020, 1, 14, 23, 50), freq="min"
-).strftime("%Y%m%d%H%M")
-# print(dates)
-bands = ["2", "11", "13", "14", "15"]
-
-# Download all the files
-for band in bands:
-    for date in dates:
-        download_CMI(date, band, data_path)
+BUCKET = "noaa-goes16"
+PRODUCT = "ABI-L2-CMIPF"
+
+
+def get_prefixes(product, start, end):
+    """
+    This function returns the bucket prefixes (product/year/day of
+    year/hour) of each hour between start and end (datetimes, inclusive).
+    """
+    prefixes = []
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour <= end:
+        prefixes.append(hour.strftime(product + "/%Y/%j/%H/"))
+        hour += timedelta(hours=1)
+    return prefixes
+
+
+def list_files(s3, bucket, prefix, bands):
+    """
+    This function lists the objects of a prefix from the given bands
+    (e.g. ["2", "13"]).
+
+    Returning a list of (key, size)
+    """
+    pattern = re.compile(
+        r"-M\dC(" + "|".join("%02d" % int(b) for b in bands) + r")_G16_s"
+    )
+    files = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if pattern.search(obj["Key"]):
+                files.append((obj["Key"], obj["Size"]))
+    return files
+
+
+def download(s3, bucket, key, size, path):
+    """
+    This function downloads an object to path through a temporary file,
+    checking its size. Files already present with the same size are
+    skipped.
+
+    Returning True if the file was downloaded
+    """
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return False
+
+    tmp = path + ".part"
+    s3.download_file(bucket, key, tmp)
+    if os.path.getsize(tmp) != size:
+        os.remove(tmp)
+        raise IOError(
+            "Size mismatch of " + key + ": expected " + str(size) + " bytes"
+        )
+    os.replace(tmp, path)
+    return True
+
+
+def main():
+    # Parser line-arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-s", "--start", help="Start date (yyyymmdd)", default="20200112"
+    )
+    parser.add_argument(
+        "-e", "--end", help="End date (yyyymmdd)", default="20200114"
+    )
+    parser.add_argument(
+        "-b", "--bands", help="Bands (e.g. 2,13)", default="2,11,13,14,15"
+    )
+    parser.add_argument(
+        "-o", "--output", help="Data path", default="data_in/g16"
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of concurrent downloads",
+        type=int,
+        default=8,
+    )
+    parser.add_argument("--bucket", help="Bucket name", default=BUCKET)
+    parser.add_argument("--product", help="Product name", default=PRODUCT)
+    parser.add_argument(
+        "--endpoint-url",
+        help="S3-compatible endpoint (e.g. a local stand-in for tests)",
+    )
+    parser.add_argument(
+        "--signed",
+        help="Sign requests with the default AWS credentials",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    # Defining data path
+    os.makedirs(args.output, exist_ok=True)
+
+    # Whole days
+    start = datetime.strptime(args.start, "%Y%m%d")
+    end = datetime.strptime(args.end, "%Y%m%d") + timedelta(
+        hours=23, minutes=59
+    )
+    bands = args.bands.split(",")
+
+    # S3 client (thread-safe), anonymous for the public bucket
+    config = Config(max_pool_connections=max(args.workers, 10))
+    if not args.signed:
+        config = config.merge(Config(signature_version=UNSIGNED))
+    s3 = boto3.client("s3", endpoint_url=args.endpoint_url, config=config)
+
+    # List existing files, one request per hour
+    files = []
+    for prefix in get_prefixes(args.product, start, end):
+        files.extend(list_files(s3, args.bucket, prefix, bands))
+    print("Files found:", len(files))
+
+    # Download all the files
+    downloaded = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(
+                download,
+                s3,
+                args.bucket,
+                key,
+                size,
+                os.path.join(args.output, os.path.basename(key)),
+            ): key
+            for key, size in files
+        }
+        for future in as_completed(futures):
+            try:
+                downloaded += future.result()
+            except Exception as e:
+                failed += 1
+                print("* Download failed:", futures[future], e)
+
+    print("Downloaded:", downloaded)
+    print("Skipped (already present):", len(files) - downloaded - failed)
+    print("Failed:", failed)
+
+
+if __name__ == "__main__":
+    main()
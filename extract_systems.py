@@ -1,40 +1,189 @@
 # -*- coding: utf-8 -*-
 
-# Adapted from tathu/examples/query-example.py
+# Exporting the systems of a tracking database (all families) to CSV or
+# Parquet, streaming the table in a single query instead of loading each
+# family with spatialite.Loader
 
+import argparse
+import csv
+import json
 import os
-import sys
-
-
-# To use local package
-sys.path.append("../")
-
-from tathu.io import spatialite, icsv
-
 
 # Setup SpatiaLite extension
 os.environ["PATH"] = (
     os.environ["PATH"] + ";../spatialite/mod_spatialite-4.3.0a-win-amd64"
 )
 
-# Setup informations to load systems from database
-dbname = "data_in/tracking-20200112-20200114.sqlite"
-table = "systems"
-
-# Load database
-db = spatialite.Loader(dbname, table)
-# print(db)
-
-# Get systems
-# by name
-names = db.loadNames()
-# print(names)
-# Save in csv
-outputter = icsv.Outputter(
-    "data_in/systems-20200112-20200114.csv",
-    outputGeom=True,
-    outputCentroid=True,
+from database import (
+    DATE_FORMAT,
+    TIMESTAMP,
+    connect,
+    get_columns,
+    iter_rows,
 )
-for name in names:
-    family = db.load(name, ["count"])
-    outputter.output(family.systems)
+
+
+# Geometry column of the systems table
+GEOMETRY = "geom"
+
+# Raster columns of the systems table (written with rasterOut), not exported
+RASTER = ("raster", "nodata", "geotransform")
+
+
+def get_types(conn, table):
+    """This function returns the declared types of the columns of a table."""
+    return {
+        row[1]: row[2].upper()
+        for row in conn.execute("PRAGMA table_info(" + table + ")")
+    }
+
+
+def get_query(conn, table, geometry):
+    """
+    This function builds the export query of a table: scalar columns (name,
+    stats, event, relationships...; no rasters), timestamp as
+    str(datetime), geometry (as returned by the SpatiaLite function given
+    by geometry, e.g. AsText), centroid as WKT (as icsv.Outputter) and its
+    lon/lat, sorted by timestamp.
+
+    Returning the query and the output column names
+    """
+    types = get_types(conn, table)
+    columns = [
+        c
+        for c in get_columns(conn, table)
+        if c != GEOMETRY and c not in RASTER and types[c] != "BLOB"
+    ]
+    fields = [
+        DATE_FORMAT.format(d=c) if c == TIMESTAMP else '"' + c + '"'
+        for c in columns
+    ]
+    fields.append(geometry + "(" + GEOMETRY + ")")
+    fields.append("AsText(Centroid(" + GEOMETRY + "))")
+    fields.append("X(Centroid(" + GEOMETRY + "))")
+    fields.append("Y(Centroid(" + GEOMETRY + "))")
+    query = "SELECT {f} FROM {t} ORDER BY {d}, rowid".format(
+        f=", ".join(fields), t=table, d=TIMESTAMP
+    )
+    return query, columns + [GEOMETRY, "centroid", "lon", "lat"]
+
+
+def export_csv(conn, table, path, chunksize=10000):
+    """
+    This function writes the systems of table to a CSV file (geometry and
+    centroid as WKT).
+
+    Returning the number of systems
+    """
+    query, columns = get_query(conn, table, "AsText")
+    count = 0
+    with open(path, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        for rows in iter_rows(conn, query, chunksize=chunksize):
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def get_schema(conn, table, columns):
+    """
+    This function returns the pyarrow schema of the exported columns, from
+    the declared types of the table (GeoParquet metadata included).
+    """
+    import pyarrow as pa
+
+    types = get_types(conn, table)
+    fields = []
+    for column in columns:
+        declared = types.get(column, "")
+        if column == TIMESTAMP:
+            dtype = pa.timestamp("s")
+        elif column == GEOMETRY or declared == "BLOB":
+            dtype = pa.binary()
+        elif column in ("lon", "lat") or declared in ("REAL", "DOUBLE"):
+            dtype = pa.float64()
+        elif "INT" in declared:
+            dtype = pa.int64()
+        else:
+            dtype = pa.string()
+        fields.append(pa.field(column, dtype))
+
+    # Systems are stored in lat/lon WGS84, the GeoParquet default CRS
+    geo = {
+        "version": "1.0.0",
+        "primary_column": GEOMETRY,
+        "columns": {GEOMETRY: {"encoding": "WKB", "geometry_types": []}},
+    }
+    return pa.schema(fields, metadata={"geo": json.dumps(geo)})
+
+
+def export_parquet(conn, table, path, chunksize=10000):
+    """
+    This function writes the systems of table to a Parquet file (geometry
+    as WKB, centroid as WKT), one row group per chunk of systems (requires
+    pyarrow).
+
+    Returning the number of systems
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    query, columns = get_query(conn, table, "AsBinary")
+    schema = get_schema(conn, table, columns)
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for rows in iter_rows(conn, query, chunksize=chunksize):
+            arrays = []
+            for field, values in zip(schema, zip(*rows)):
+                if field.name == TIMESTAMP:
+                    array = pc.strptime(
+                        pa.array(values, pa.string()),
+                        "%Y-%m-%d %H:%M:%S",
+                        "s",
+                    )
+                else:
+                    array = pa.array(values, field.type)
+                arrays.append(array)
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(rows)
+    return count
+
+
+def main():
+    # Parser line-arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--database",
+        help="Tracking database",
+        default="data_in/tracking-20200112-20200114.sqlite",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Output file (.csv or .parquet)",
+        default="data_in/systems-20200112-20200114.csv",
+    )
+    parser.add_argument("-t", "--table", help="Table name", default="systems")
+    parser.add_argument(
+        "--chunksize",
+        help="Systems read/written at once",
+        type=int,
+        default=10000,
+    )
+    args = parser.parse_args()
+
+    conn = connect(args.database)
+    if args.output.endswith(".parquet"):
+        count = export_parquet(conn, args.table, args.output, args.chunksize)
+    else:
+        count = export_csv(conn, args.table, args.output, args.chunksize)
+    conn.close()
+
+    print("Systems exported:", count, "->", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,87 +5,89 @@
 import os
 import sys
 from glob import glob
-import pickle
-import random
+import configparser
 
-import numpy as np
 import matplotlib.pyplot as plt
 
-from osgeo import gdal
-
 
 # To use local package
 sys.path.append("../")
 
-from tathu.constants import LAT_LON_WGS84, KM_PER_DEGREE
-from tathu.utils import file2timestamp, getExtent
-from tathu.satellite import goes16
-
-
-def read_sample_g16(file, timestamp):
+from tathu.constants import LAT_LON_WGS84
+from tathu.io import spatialite
+
+import catalog_g16
+import patches
+import remap_g16
+from database import SystemsCache
+from manifest import Manifest
+from patch_store import PatchStore
+
+
+def read_sample_g16(
+    file,
+    timestamp,
+    extent,
+    resolution,
+    lutdir,
+    cachedir=None,
+    cachesize=2048,
+    systems=None,
+    samples=3,
+    sizearray=150,
+):
     """
     This function:
 
-    - Reads GOES-16 data and convert to grid
-    - Get random samples with same array size
+    - Reads GOES-16 data and convert to grid (see remap_g16.remap_array)
+    - Get random non-overlapping samples with same array size (away from
+      the given systems, if any)
 
-    Returning two lists of data arrays and band info
+    Returning the (N, sizearray, sizearray) data array, band info and
+    (lon, lat) centers
     """
 
-    # Read data and map channel to 2km
+    # Read data and map channel to the grid
     print("Reading grid")
-    extent = [-85.0, -60.0, -30.0, 15.0]
-    grid = goes16.sat2grid(
-        file, extent, 2.0, LAT_LON_WGS84, "HDF5", progress=None
+    grid = remap_g16.remap_array(
+        file,
+        extent,
+        resolution,
+        LAT_LON_WGS84,
+        lutdir,
+        cachedir=cachedir,
+        cachesize=cachesize,
     )
-    img_band = file[42:45]
+    geotransform = remap_g16.get_geotransform(extent, *grid.shape)
+    img_band = catalog_g16.get_band(file)
     # print(img_band)
     # print(type(grid))
     # Quick plot
-    # plt.imshow(grid.ReadAsArray())
+    # plt.imshow(grid)
 
     # Create array by random sample
     print("Creating random arrays")
-    imgs_random = []
-    imgs_band = []
-    # Create lat/lon grid for random centroid sample
-    sizex = int(((extent[2] - extent[0]) * KM_PER_DEGREE) / 2.0)
-    sizey = int(((extent[3] - extent[1]) * KM_PER_DEGREE) / 2.0)
-    gridlat, gridlon = np.mgrid[
-        extent[1] : extent[3] : complex(0, sizey),
-        extent[0] : extent[2] : complex(0, sizex),
-    ]
-    # print(sizex, sizey)
-    sizearray = 150
-    center_lons = random.sample(range(75, sizex - 75), k=3)
-    center_lats = random.sample(range(75, sizey - 75), k=3)
-    for plon, plat in zip(center_lons, center_lats):
-        # Subset grid
-        subgrid = gdal.Translate(
-            "/vsimem/in_memory_output.tif",
-            grid,
-            projWin=[
-                gridlon[0, int(plon - sizearray / 2)],
-                gridlat[int(plat + sizearray / 2), 0],
-                gridlon[0, int(plon + sizearray / 2)],
-                gridlat[int(plat - sizearray / 2), 0],
-            ],
-        ).ReadAsArray()
-        # print(subgrid.shape)
-
-        # Quick plot
-        # plt.imshow(subgrid)
-        # plt.colorbar()
-
-        # Append images
-        imgs_random.append(subgrid)
-        imgs_band.append(img_band)
+    boxes = None
+    if systems is not None:
+        boxes = patches.get_boxes(systems, geotransform)
+    lines, cols = patches.sample_windows(grid.shape, sizearray, samples, boxes)
+    imgs_random = patches.cut_windows(grid, lines, cols, sizearray)
+    # print(imgs_random.shape)
+
+    # Quick plot
+    # plt.imshow(imgs_random[0])
+    # plt.colorbar()
+
+    # Centers of the windows
+    lons = geotransform[0] + geotransform[1] * (cols + sizearray / 2)
+    lats = geotransform[3] + geotransform[5] * (lines + sizearray / 2)
+    imgs_center = list(zip(lons, lats))
 
     print("Done! " + str(timestamp) + " - " + img_band)
 
-    del grid, subgrid
+    del grid
 
-    return imgs_random, imgs_band
+    return imgs_random, img_band, imgs_center
 
 
 # Setup SpatiaLite extension
@@ -93,36 +95,63 @@ os.environ["PATH"] = (
     os.environ["PATH"] + ";../spatialite/mod_spatialite-4.3.0a-win-amd64"
 )
 
-# Get files and timestamps
-files = glob("misc/term_project-aga5926/data/*.nc")
-timestamps = [
-    file2timestamp(file, yearpos=59, format="%Y%j%H%M%S") for file in files
-]
+# Get files and timestamps: the one of the C13 file of the same scan,
+# as the systems (sorted, so systems are loaded once per day)
+files = sorted(glob("misc/term_project-aga5926/data/*.nc"))
+timestamps = catalog_g16.get_timestamps(files)
+files.sort(key=timestamps.get)
 # print(len(timestamps))
 
-# Get random arrays by date
-imgs_random = []
-imgs_band = []
-
-# Populating arrays
-for file, timestamp in zip(files, timestamps):
-    grid_random, band = read_sample_g16(file, timestamp)
-    imgs_random.append(grid_random)
-    imgs_band.append(band)
-
-# See total length of final list
-# count = 0
-# for step in imgs_band:
-#     count += len(step)
-# print("Total of systems:", count)
-
-# Save arrays in pickle objects
-with open(
-    "misc/term_project-aga5926/data/imgs_random.pickle", "wb"
-) as output:
-    pickle.dump(imgs_random, output, protocol=pickle.HIGHEST_PROTOCOL)
-with open(
-    "misc/term_project-aga5926/data/imgs_random_band.pickle", "wb"
-) as output:
-    pickle.dump(imgs_band, output, protocol=pickle.HIGHEST_PROTOCOL)
+# Sampling parameters and grid settings (the same of build_dataset.py)
+config = configparser.ConfigParser()
+config.read("config-dataset.ini")
+samples = config.getint("Sampling", "samples")
+dbname = config.get("Sampling", "database", fallback="")
+extent = [float(i) for i in config.get("Dataset", "extent").split(",")]
+resolution = config.getfloat("Dataset", "resolution")
+lutdir = config.get("Dataset", "lutdir")
+cachedir = config.get("Dataset", "cachedir", fallback="")
+cachesize = config.getint("Dataset", "cachesize", fallback=2048)
+settings = (extent, resolution, lutdir, cachedir, cachesize)
+
+# Systems to avoid, if a tracking database is given
+cache = None
+dependencies = []
+if dbname:
+    cache = SystemsCache(spatialite.Loader(dbname, "systems"))
+    dependencies = [dbname]
+
+# Store of random arrays (see patch_store.py)
+store = PatchStore("misc/term_project-aga5926/data/random", (150, 150))
+
+# Only new files are sampled; everything if the parameters changed
+parameters = {"sizearray": 150, "samples": samples, "database": dbname}
+manifest = Manifest(store.path, "random", parameters)
+if len(store) < manifest.count:
+    manifest.reset()
+pending = set(manifest.get_pending(files, dependencies))
+store.truncate(manifest.count)
+print("Files to process:", len(pending), "of", len(files))
+
+# Populating store
+for file in files:
+    if file not in pending:
+        continue
+    timestamp = timestamps[file]
+    systems = None if cache is None else cache.get(timestamp)
+    grid_random, band, center = read_sample_g16(
+        file, timestamp, *settings, systems=systems, samples=samples
+    )
+    store.append(
+        grid_random,
+        timestamp=timestamp,
+        band=band,
+        centroids=center,
+        file=os.path.basename(file),
+    )
+    manifest.add([file], len(store))
 
+# See total length of final store
+print("Total of samples:", len(store))
+manifest.close()
+store.close()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Manifests of the dataset stages (masking, random sampling, normalization).
+# Each stage output (a patch store directory) keeps the parameters it was
+# built with and the content hashes of the inputs already processed, so a
+# rerun only processes new inputs and starts over when the parameters or
+# any processed input change.
+
+import hashlib
+import json
+import os
+import uuid
+
+
+# Manifest file of a stage output directory
+MANIFEST = "manifest.json"
+
+# Bytes read at once when hashing files
+HASH_BLOCK = 1 << 20
+
+# Inputs added between two writes of a manifest
+SAVE_INTERVAL = 100
+
+
+def get_hash(path, entry=None):
+    """
+    This function returns the content hash (sha1) of a file, reusing the
+    hash of entry (a manifest record) if the file size and modification
+    time are unchanged.
+    """
+    stat = os.stat(path)
+    if (
+        entry is not None
+        and entry["size"] == stat.st_size
+        and entry["mtime"] == stat.st_mtime
+    ):
+        return entry["hash"]
+
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as input:
+        for block in iter(lambda: input.read(HASH_BLOCK), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_entry(path, entry=None):
+    """
+    This function returns the manifest record of a file (see get_hash for
+    entry).
+    """
+    stat = os.stat(path)
+    return {
+        "hash": get_hash(path, entry),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+def read_manifest(directory):
+    """
+    This function returns the saved manifest of a directory as a dict
+    (empty if there is none), e.g. to get the id of an upstream stage.
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as input:
+        return json.load(input)
+
+
+class Manifest(object):
+    """
+    This class reads/writes the manifest of a stage output directory: stage
+    name, parameters (JSON values), an id (new at each restart of the
+    stage), the number of outputs (e.g. patches) written and the records
+    of processed inputs and dependencies (e.g. the tracking database).
+
+    The manifest is written every interval added inputs and by close().
+    Outputs written after the last save are dropped by the next run (its
+    count is behind the store), and their inputs processed again.
+    """
+
+    def __init__(self, directory, stage, parameters, interval=SAVE_INTERVAL):
+        self.path = os.path.join(directory, MANIFEST)
+        self.stage = stage
+        self.interval = interval
+        self.unsaved = 0
+        # Normalized as saved (e.g. tuples become lists)
+        self.parameters = json.loads(json.dumps(parameters))
+
+        saved = read_manifest(directory)
+        if saved.get("parameters") == self.parameters:
+            self.id = saved["id"]
+            self.count = saved["count"]
+            self.inputs = saved["inputs"]
+            self.dependencies = saved["dependencies"]
+        else:
+            if saved:
+                print("* Parameters changed, starting over:", directory)
+            self.reset()
+
+    def reset(self):
+        """This method forgets all processed inputs."""
+        self.id = uuid.uuid4().hex
+        self.count = 0
+        self.inputs = {}
+        self.dependencies = {}
+
+    def get_pending(self, paths, dependencies=()):
+        """
+        This method returns the paths not processed yet. If a dependency or
+        a processed input changed, the manifest is reset and all paths are
+        returned.
+        """
+        current = {}
+        changed = False
+        for path in dependencies:
+            entry = self.dependencies.get(path)
+            current[path] = get_entry(path, entry)
+            if entry is None or current[path]["hash"] != entry["hash"]:
+                if self.inputs:
+                    print("* Dependency changed, starting over:", path)
+                changed = True
+        if changed:
+            self.reset()
+        self.dependencies = current
+
+        pending = []
+        for path in paths:
+            entry = self.inputs.get(path)
+            if entry is None:
+                pending.append(path)
+            elif get_hash(path, entry) != entry["hash"]:
+                print("* Input changed, starting over:", path)
+                self.reset()
+                self.dependencies = current
+                return list(paths)
+        return pending
+
+    def add(self, paths, count):
+        """
+        This method records paths as processed, with count outputs written
+        so far, saving the manifest every interval calls.
+        """
+        for path in paths:
+            self.inputs[path] = get_entry(path)
+        self.count = count
+        self.unsaved += 1
+        if self.unsaved >= self.interval:
+            self.save()
+
+    def close(self):
+        """This method saves the inputs added since the last save."""
+        if self.unsaved:
+            self.save()
+
+    def save(self):
+        """This method writes the manifest (atomically)."""
+        manifest = {
+            "stage": self.stage,
+            "parameters": self.parameters,
+            "id": self.id,
+            "count": self.count,
+            "inputs": self.inputs,
+            "dependencies": self.dependencies,
+        }
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as output:
+            json.dump(manifest, output, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.unsaved = 0
@@ -5,216 +5,257 @@
 import os
 import sys
 from glob import glob
-import pickle
-import math
+import configparser
 
 import numpy as np
 import matplotlib.pyplot as plt
 
-from osgeo import gdal
-
 
 # To use local package
 sys.path.append("../")
 
 from tathu.io import spatialite
 from tathu.constants import LAT_LON_WGS84
-from tathu.utils import file2timestamp, getExtent
-from tathu.satellite import goes16
+
+import catalog_g16
+import patches
+import remap_g16
+from database import SystemsCache
+from manifest import Manifest
+from patch_store import PatchStore
+
+
+# Bands stacked as channels (in this order) by read_mask_g16_stacked
+BANDS = ["C02", "C11", "C13", "C14", "C15"]
+
+
+def get_centroids(systems):
+    """This function returns the (lon, lat) centroids of systems."""
+    centroids = [s.getCentroid() for s in systems]
+    return [(c.GetX(), c.GetY()) for c in centroids]
 
 
-def read_mask_g16(file, db, timestamp):
+def read_mask_g16(
+    file,
+    systems,
+    timestamp,
+    extent,
+    resolution,
+    lutdir,
+    cachedir=None,
+    cachesize=2048,
+    sizearray=150,
+    oversize="crop",
+):
     """
     This function:
 
-    - Reads GOES-16 data and convert to grid
-    - Get polygons of systems identified by TATHU
-    - Creates mask from polygon raster
-    - Creates subgrid of the same size as the mask
+    - Reads GOES-16 data and convert to grid (see remap_g16.remap_array)
+    - Get rasters of systems identified by TATHU (systems of timestamp)
+    - Cuts a sizearray x sizearray subgrid centred on each system, with the
+      mask of its raster (oversize systems are cropped or downsampled, see
+      patches.build_patches)
     - Applies mask
 
-    Returning 3 lists of masked and unmasked data arrays and band info
+    Returning masked and unmasked (N, sizearray, sizearray) arrays and band
+    info
     """
 
-    # Read data and map channel to 2km
+    # Read data and map channel to the grid
     print("Reading grid")
-    extent = [-85.0, -60.0, -30.0, 15.0]
-    grid = goes16.sat2grid(
-        file, extent, 2.0, LAT_LON_WGS84, "HDF5", progress=None
+    grid = remap_g16.remap_array(
+        file,
+        extent,
+        resolution,
+        LAT_LON_WGS84,
+        lutdir,
+        cachedir=cachedir,
+        cachesize=cachesize,
     )
-    img_band = file[42:45]
+    geotransform = remap_g16.get_geotransform(extent, *grid.shape)
+    img_band = catalog_g16.get_band(file)
     # print(img_band)
     # print(type(grid))
     # Quick plot
-    # plt.imshow(grid.ReadAsArray())
-
-    # Select systems by timestamp
-    print("Loading systems")
-    systems = db.loadByDate("%Y-%m-%d %H:%M:%S", str(timestamp), [])
+    # plt.imshow(grid)
 
     # Create mask by raster
     print("Creating masked/unmasked arrays")
-    imgs_nomask = []
-    imgs_mask = []
-    imgs_band = []
-    sizearray = 150
-    for sys in systems:
-        # sys = systems[0]
-        # print(dir(sys))
-
-        # Get polygon
-        poly = sys.raster
-        # print(np.min(poly), np.max(poly))
-        poly_centroid = sys.getCentroid()
-        # Normalizing size
-        padx = abs(sizearray - poly.shape[0])
-        pady = abs(sizearray - poly.shape[1])
-        # print("padx,y", padx, pady)
-        if padx % 2 == 0:
-            lpad = int(padx / 2)
-            rpad = int(padx / 2)
-            if pady % 2 == 0:
-                upad = int(pady / 2)
-                dpad = int(pady / 2)
-                poly = np.pad(
-                    poly,
-                    ((lpad, rpad), (upad, dpad)),
-                    "constant",
-                    constant_values=(-999,),
-                )
-            else:
-                upad = math.floor(pady / 2)
-                dpad = math.ceil(pady / 2)
-                # print("u,dpad", upad, dpad)
-                poly = np.pad(
-                    poly,
-                    ((lpad, rpad), (upad, dpad)),
-                    "constant",
-                    constant_values=(-999,),
-                )
-        else:
-            lpad = math.floor(padx / 2)
-            rpad = math.ceil(padx / 2)
-            # print("l,rpad", lpad, rpad)
-            if pady % 2 == 0:
-                upad = int(pady / 2)
-                dpad = int(pady / 2)
-                poly = np.pad(
-                    poly,
-                    ((lpad, rpad), (upad, dpad)),
-                    "constant",
-                    constant_values=(-999,),
-                )
-            else:
-                upad = math.floor(pady / 2)
-                dpad = math.ceil(pady / 2)
-                # print(upad, dpad)
-                poly = np.pad(
-                    poly,
-                    ((lpad, rpad), (upad, dpad)),
-                    "constant",
-                    constant_values=(-999,),
-                )
-        poly = np.in1d(poly, -999).reshape(poly.shape)
-        poly_mask = np.ma.getmaskarray(poly)
-
-        poly_extent = getExtent(sys.geotransform, poly.shape)
-        # print(poly_mask.shape)
-        # print(poly_extent)
-        # Quick plot
-        # plt.imshow(poly_mask)
-        # plt.colorbar()
-
-        # Subset grid
-        subgrid = gdal.Translate(
-            "/vsimem/in_memory_output.tif",
-            grid,
-            projWin=[
-                poly_extent[0],
-                poly_extent[3],
-                poly_extent[2],
-                poly_extent[1],
-            ],
-        ).ReadAsArray()
-        # print(subgrid.shape)
-
-        # Mask grid
-        subgrid_masked = np.ma.array(subgrid, mask=poly_mask)
-        # print(subgrid_masked)
-
-        # Quick plot
-        # plt.imshow(subgrid_masked)
-        # plt.colorbar()
-
-        # Append images
-        imgs_nomask.append(subgrid)
-        imgs_mask.append(subgrid_masked)
-        imgs_band.append(img_band)
+    imgs_nomask, mask, count = patches.build_patches(
+        grid, geotransform, systems, sizearray, oversize
+    )
+    imgs_mask = np.ma.array(imgs_nomask, mask=mask)
+    imgs_band = [img_band] * len(systems)
+
+    # Quick plot
+    # plt.imshow(imgs_mask[0])
+    # plt.colorbar()
 
     print("Done! " + str(timestamp) + " - " + img_band)
+    if count:
+        print("Oversize systems (" + oversize + "):", count)
 
-    del grid, systems
+    del grid
 
     return imgs_nomask, imgs_mask, imgs_band
 
 
+def read_mask_g16_stacked(
+    files,
+    systems,
+    timestamp,
+    extent,
+    resolution,
+    lutdir,
+    cachedir=None,
+    cachesize=2048,
+    sizearray=150,
+    oversize="crop",
+):
+    """
+    This function does the same of read_mask_g16 for all bands of a scan
+    time at once (files, in the BANDS order):
+
+    - Remaps the files into a single multi-band array
+    - Cuts the window of each system from all bands together
+
+    Returning (N, sizearray, sizearray, bands) arrays, unmasked and masked
+    """
+    print("Reading grids")
+    # Read one by one: the netCDF-C library isn't thread-safe (see
+    # build_dataset.py for scan times processed in parallel)
+    arrays = [
+        remap_g16.remap_array(
+            file,
+            extent,
+            resolution,
+            LAT_LON_WGS84,
+            lutdir,
+            cachedir=cachedir,
+            cachesize=cachesize,
+        )
+        for file in files
+    ]
+    # (lines, columns, bands) shaped, so windows are already stacked
+    grid = np.stack(arrays, axis=-1)
+    geotransform = remap_g16.get_geotransform(extent, *grid.shape[:2])
+    del arrays
+
+    print("Creating masked/unmasked arrays")
+    imgs_nomask, mask, count = patches.build_patches(
+        grid, geotransform, systems, sizearray, oversize
+    )
+    mask = np.broadcast_to(mask[:, :, :, np.newaxis], imgs_nomask.shape)
+
+    print("Done! " + str(timestamp) + " - " + str(len(systems)) + " systems")
+    if count:
+        print("Oversize systems (" + oversize + "):", count)
+
+    del grid
+
+    return imgs_nomask, np.ma.array(imgs_nomask, mask=mask)
+
+
 # Setup SpatiaLite extension
 os.environ["PATH"] = (
     os.environ["PATH"] + ";../spatialite/mod_spatialite-4.3.0a-win-amd64"
 )
 
-# Get files and timestamps
-files = glob("/mnt/d/Data/g16/aga5926/*.nc")
-timestamps = [
-    file2timestamp(file, yearpos=59, format="%Y%j%H%M%S") for file in files
-]
+# Grid settings (the same of build_dataset.py)
+config = configparser.ConfigParser()
+config.read("config-dataset.ini")
+extent = [float(i) for i in config.get("Dataset", "extent").split(",")]
+resolution = config.getfloat("Dataset", "resolution")
+lutdir = config.get("Dataset", "lutdir")
+cachedir = config.get("Dataset", "cachedir", fallback="")
+cachesize = config.getint("Dataset", "cachesize", fallback=2048)
+settings = (extent, resolution, lutdir, cachedir, cachesize)
+
+# Get files and timestamps: the one of the C13 file of the same scan,
+# as the systems (sorted, so systems are loaded once per day)
+files = sorted(glob("/mnt/d/Data/g16/aga5926/*.nc"))
+timestamps = catalog_g16.get_timestamps(files)
+files.sort(key=timestamps.get)
 # print(len(timestamps))
 
 # Setup information to load systems from database
 dbname = "misc/term_project-aga5926/data/tracking-20200112-20200114.sqlite"
 table = "systems"
 
-# Load database
+# Load database, indexing systems by timestamp
 db = spatialite.Loader(dbname, table)
+cache = SystemsCache(db)
 # print(db)
 
-# Get masked and unmasked arrays by date
-imgs_nomask = []
-imgs_mask = []
-imgs_band = []
-
-# Open arrays in pickle objects (IF NECESSARY)
-# with open("misc/term_project-aga5926/data/imgs_nomask.pickle", "rb") as input:
-#     imgs_nomask = pickle.load(input)
-# with open("misc/term_project-aga5926/data/imgs_mask.pickle", "rb") as input:
-#     imgs_mask = pickle.load(input)
-# with open("misc/term_project-aga5926/data/imgs_band.pickle", "rb") as input:
-#     imgs_band = pickle.load(input)
-
-# Populating arrays
-for file, timestamp in zip(files, timestamps):
-    nomask, mask, band = read_mask_g16(file, db, timestamp)
-    imgs_nomask.append(nomask)
-    imgs_mask.append(mask)
-    imgs_band.append(band)
-
-# See total length of final list
-# count = 0
-# for step in imgs_band:
-#     count += len(step)
-# print("Total of systems:", count)
-
-# Save arrays in pickle objects
-with open(
-    "misc/term_project-aga5926/data/imgs_nomask.pickle", "wb"
-) as output:
-    pickle.dump(imgs_nomask, output, protocol=pickle.HIGHEST_PROTOCOL)
-with open(
-    "misc/term_project-aga5926/data/imgs_mask.pickle", "wb"
-) as output:
-    pickle.dump(imgs_mask, output, protocol=pickle.HIGHEST_PROTOCOL)
-with open(
-    "misc/term_project-aga5926/data/imgs_band.pickle", "wb"
-) as output:
-    pickle.dump(imgs_band, output, protocol=pickle.HIGHEST_PROTOCOL)
-
+# Stores of masked/unmasked arrays (see patch_store.py)
+datadir = "misc/term_project-aga5926/data/"
+
+# Extraction mode: stack the bands of each scan time as channels
+stacked = False
+
+# Systems larger than the arrays: "crop" or "downsample"
+oversize = "crop"
+
+# Parameters recorded in the manifest of the store
+parameters = {"sizearray": 150, "oversize": oversize, "stacked": stacked}
+if stacked:
+    parameters["bands"] = BANDS
+
+if stacked:
+    store = PatchStore(datadir + "stacked", (150, 150, len(BANDS)))
+else:
+    store = PatchStore(datadir + "systems", (150, 150))
+
+# Only new files are processed; everything if the parameters or the
+# systems database changed
+manifest = Manifest(store.path, "mask", parameters)
+if len(store) < manifest.count:
+    manifest.reset()
+pending = set(manifest.get_pending(files, [dbname]))
+store.truncate(manifest.count)
+print("Files to process:", len(pending), "of", len(files))
+
+# Populating store
+if stacked:
+    for timestamp, group in catalog_g16.group_files(files, BANDS):
+        if not pending.intersection(group):
+            continue
+        systems = cache.get(timestamp)
+        nomask, mask = read_mask_g16_stacked(
+            group, systems, timestamp, *settings, oversize=oversize
+        )
+        # Masks are the same for all bands
+        store.append(
+            nomask,
+            np.ma.getmaskarray(mask)[..., 0],
+            [s.name for s in systems],
+            timestamp,
+            ",".join(BANDS),
+            get_centroids(systems),
+            os.path.basename(group[0]),
+        )
+        manifest.add(group, len(store))
+else:
+    for file in files:
+        if file not in pending:
+            continue
+        timestamp = timestamps[file]
+        systems = cache.get(timestamp)
+        nomask, mask, band = read_mask_g16(
+            file, systems, timestamp, *settings, oversize=oversize
+        )
+        store.append(
+            nomask,
+            np.ma.getmaskarray(mask),
+            [s.name for s in systems],
+            timestamp,
+            catalog_g16.get_band(file),
+            get_centroids(systems),
+            os.path.basename(file),
+        )
+        manifest.add([file], len(store))
+
+# See total length of final store
+print("Total of systems:", len(store))
+manifest.close()
+store.close()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+# Outputs of tracked systems recording per-image checkpoints, including a
+# write-behind one: frames are queued by the tracking loop and written to
+# SpatiaLite by a background thread, several frames per write
+
+import atexit
+import queue
+import sqlite3
+import threading
+
+from tathu.io import spatialite
+
+from database import connect, save_checkpoint, update_families
+
+
+class OutputError(Exception):
+    """
+    This exception is raised when systems can't be written, so tracking
+    stops instead of going on without them.
+    """
+
+
+class Outputter(object):
+    """
+    This class writes systems with spatialite.Outputter, folds them into
+    the families summary table (see database.update_families) and then
+    records the given checkpoint, a (period, timestamp) tuple, in the
+    database.
+    """
+
+    def __init__(self, database, table, columns):
+        self.outputter = spatialite.Outputter(database, table, columns)
+        self.conn = connect(database)
+        self.table = table
+        self.columns = columns
+
+    def output(self, systems, checkpoint=None):
+        try:
+            self.write([systems], [checkpoint])
+        except Exception as e:
+            raise OutputError("Writing systems failed: " + str(e)) from e
+
+    def write(self, frames, checkpoints):
+        """This method writes several frames in a single Outputter call."""
+        systems = [s for frame in frames for s in frame]
+        if systems:
+            self.outputter.output(systems)
+            update_families(self.conn, self.columns, self.table)
+        for checkpoint in checkpoints:
+            if checkpoint is not None:
+                save_checkpoint(self.conn, *checkpoint)
+
+    def close(self):
+        """This method closes the connections to the database."""
+        # spatialite.Outputter has no close(), its connection is closed here
+        self.outputter.conn.close()
+        self.conn.close()
+
+
+class BackgroundOutputter(object):
+    """
+    This class has the interface of Outputter, but output() only queues the
+    systems (blocking if queuesize frames are already waiting). A
+    background thread owns the actual Outputter (SQLite connections belong
+    to the thread that creates them) and writes up to batchsize queued
+    frames in a single call, recording their checkpoints only afterwards
+    (systems left without them by a crash are discarded at resume, see
+    database.discard_unchecked). The database is switched to WAL mode, so
+    other connections can read it meanwhile, and back to the default
+    rollback journal when the thread stops (WAL isn't supported on network
+    filesystems, so the database is left as a single file).
+
+    Queued systems must not be modified afterwards. flush() waits for the
+    queued frames to be written and close() also stops the thread (it is
+    called at interpreter exit too). A failed write is raised as
+    OutputError by the next output(), flush() or close() call.
+    """
+
+    def __init__(self, database, table, columns, queuesize=16, batchsize=8):
+        self.queue = queue.Queue(queuesize)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(database, table, columns, batchsize),
+            daemon=True,
+        )
+        self.thread.start()
+        atexit.register(self.close)
+
+    def check(self):
+        """This method raises the error of the writer thread, if any."""
+        if self.error is not None:
+            raise OutputError(
+                "Writing systems failed: " + str(self.error)
+            ) from self.error
+
+    def output(self, systems, checkpoint=None):
+        self.check()
+        self.queue.put((systems, checkpoint))
+
+    def flush(self):
+        """This method waits until all queued frames are written."""
+        self.queue.join()
+        self.check()
+
+    def run(self, database, table, columns, batchsize):
+        """This method writes queued frames until close() is called."""
+        # Errors are raised by output()/flush()/close(), queued frames are
+        # consumed anyway so the tracking loop never blocks
+        outputter = None
+        try:
+            conn = sqlite3.connect(database)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.close()
+            outputter = Outputter(database, table, columns)
+        except Exception as e:
+            self.error = e
+
+        done = False
+        while not done:
+            # Wait for a frame, then take the ones already waiting
+            frames = [self.queue.get()]
+            while len(frames) < batchsize and frames[-1] is not None:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None is queued by close()
+            if frames[-1] is None:
+                frames.pop()
+                done = True
+
+            if frames and self.error is None:
+                try:
+                    outputter.write(
+                        [systems for systems, _ in frames],
+                        [checkpoint for _, checkpoint in frames],
+                    )
+                except Exception as e:
+                    self.error = e
+
+            # Frames (and the final None) are done, written or not
+            for _ in range(len(frames) + done):
+                self.queue.task_done()
+
+        if outputter is None:
+            return
+        try:
+            outputter.close()
+            conn = sqlite3.connect(database)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.close()
+        except Exception as e:
+            print("* Database left in WAL mode:", database, e)
+
+    def close(self):
+        """This method writes all queued frames and stops the thread."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+# Overlap strategy for trackers.OverlapAreaTracker that prefilters the
+# pairs of systems by their bounding boxes, so geometric intersections are
+# computed only for pairs that may actually overlap
+
+import numpy as np
+
+
+def get_boxes(systems):
+    """This function returns the envelopes (minx, maxx, miny, maxy)."""
+    boxes = np.empty((len(systems), 4))
+    for i, s in enumerate(systems):
+        boxes[i] = s.geom.GetEnvelope()
+    return boxes
+
+
+class IndexedOverlapStrategy(object):
+    """
+    This class wraps an overlap area strategy (e.g.
+    trackers.RelativeOverlapAreaStrategy), delegating only pairs whose
+    bounding boxes intersect. Systems with disjoint boxes do not intersect,
+    so associations are the same of the wrapped strategy for any overlap
+    threshold > 0.
+
+    index() must be called with the systems of each tracking step.
+    """
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.candidates = set()
+        # Pairs tested by the wrapped strategy
+        self.tested = 0
+
+    def index(self, previous, current):
+        """This method finds the candidate pairs of a tracking step."""
+        self.candidates = set()
+        self.tested = 0
+
+        if not previous or not current:
+            return
+
+        p = get_boxes(previous)
+        c = get_boxes(current)
+        # Box intersection test of all pairs, (current, previous) shaped
+        hits = (
+            (c[:, None, 0] <= p[None, :, 1])
+            & (c[:, None, 1] >= p[None, :, 0])
+            & (c[:, None, 2] <= p[None, :, 3])
+            & (c[:, None, 3] >= p[None, :, 2])
+        )
+        for i, j in zip(*np.nonzero(hits)):
+            self.candidates.add((id(current[i]), id(previous[j])))
+            self.candidates.add((id(previous[j]), id(current[i])))
+
+    def hasOverlap(self, s1, s2):
+        if (id(s1), id(s2)) not in self.candidates:
+            return False
+        self.tested += 1
+        return self.strategy.hasOverlap(s1, s2)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+# Append-only on-disk store of fixed-shape patches, replacing pickled lists
+# of arrays. A store is a directory with the patches (float32 values or
+# uint16 scaled counts) and their masks (bool) as raw arrays, read through
+# memory maps, and a SQLite table with the metadata of each patch.
+
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+
+# Files of a store (patches file by data type)
+DATA = {"float32": "data.f32", "uint16": "data.u16"}
+MASKS = "masks.b8"
+METADATA = "metadata.sqlite"
+
+# Counts without data (as remap_g16.COUNT_NODATA) and their decoded value
+# (as remap_g16.NODATA)
+COUNT_NODATA = 65535
+NODATA = -1
+
+
+class PatchStore(object):
+    """
+    This class appends patches (e.g. (150, 150) or (150, 150, bands)
+    shaped) to a store and gives random access to them as memory maps:
+    patch i is data[i], with mask masks[i] (True outside the system, shared
+    by all bands) and metadata row id i (system name, timestamp, band,
+    centroid lon/lat and source file).
+
+    Patches are float32 or, with dtype = "uint16", scaled integer counts
+    of each band, converted to float32 by decode() with the scale/offset
+    of their bands (set by append()).
+
+    The metadata is committed after the arrays are written, so patches of
+    an interrupted append are discarded by the next one.
+    """
+
+    def __init__(self, path, shape=None, dtype=None):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(os.path.join(path, METADATA))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS store "
+            "(key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS patches (id INTEGER PRIMARY KEY, "
+            "name TEXT, timestamp TEXT, band TEXT, lon REAL, lat REAL, "
+            "file TEXT)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS patches_timestamp "
+            "ON patches (timestamp)"
+        )
+
+        saved = dict(self.conn.execute("SELECT key, value FROM store"))
+        if "shape" in saved:
+            self.shape = tuple(json.loads(saved["shape"]))
+            if shape is not None and tuple(shape) != self.shape:
+                raise ValueError(
+                    "Patch store shape is " + str(self.shape) + ", not "
+                    + str(tuple(shape))
+                )
+        elif shape is None:
+            raise ValueError("New patch store requires a shape: " + path)
+        else:
+            self.shape = tuple(int(i) for i in shape)
+            self.conn.execute(
+                "INSERT INTO store VALUES ('shape', ?)",
+                (json.dumps(self.shape),),
+            )
+
+        if "dtype" in saved:
+            self.dtype = saved["dtype"]
+        elif "shape" in saved:
+            # Stores created before the uint16 option
+            self.dtype = "float32"
+        else:
+            self.dtype = dtype or "float32"
+        if dtype is not None and dtype != self.dtype:
+            raise ValueError(
+                "Patch store data type is " + self.dtype + ", not " + dtype
+            )
+        if self.dtype not in DATA:
+            raise ValueError("Unsupported patch store type: " + self.dtype)
+        self.conn.execute(
+            "INSERT OR IGNORE INTO store VALUES ('dtype', ?)", (self.dtype,)
+        )
+        # {band: (scale, offset)} of counts
+        self.scaling = {
+            band: tuple(value)
+            for band, value in json.loads(saved.get("scaling", "{}")).items()
+        }
+        self.conn.commit()
+
+        self.count = self.conn.execute(
+            "SELECT COUNT(*) FROM patches"
+        ).fetchone()[0]
+        self.files = None
+        self.maps = None
+
+    def __len__(self):
+        return self.count
+
+    def open_files(self):
+        """
+        This method opens the arrays to append, dropping patches without
+        committed metadata.
+        """
+        self.files = []
+        for name, dtype, shape in (
+            (DATA[self.dtype], self.dtype, self.shape),
+            (MASKS, bool, self.shape[:2]),
+        ):
+            size = np.dtype(dtype).itemsize * int(np.prod(shape))
+            output = open(os.path.join(self.path, name), "ab")
+            output.truncate(self.count * size)
+            self.files.append(output)
+
+    def set_scaling(self, scaling):
+        """
+        This method records the scale and offset of the counts of bands
+        ({band: (scale, offset)}), which can't change once recorded.
+        """
+        changed = False
+        for band, value in scaling.items():
+            value = tuple(float(i) for i in value)
+            if band not in self.scaling:
+                self.scaling[band] = value
+                changed = True
+            elif not np.allclose(self.scaling[band], value):
+                raise ValueError(
+                    "Scale/offset of " + band + " is "
+                    + str(self.scaling[band]) + ", not " + str(value)
+                )
+        if changed:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO store VALUES ('scaling', ?)",
+                (json.dumps(self.scaling),),
+            )
+            self.conn.commit()
+
+    def append(
+        self,
+        data,
+        masks=None,
+        names=None,
+        timestamp=None,
+        band=None,
+        centroids=None,
+        file=None,
+        scaling=None,
+    ):
+        """
+        This method appends patches, with their masks (nothing masked, by
+        default), system names and (lon, lat) centroids, all from the same
+        timestamp, band and source file. Counts (uint16 stores) require the
+        scale and offset of their bands ({band: (scale, offset)}), unless
+        already recorded.
+        """
+        if scaling is not None:
+            self.set_scaling(scaling)
+        if self.dtype == "uint16" and band is not None:
+            missing = [b for b in band.split(",") if b not in self.scaling]
+            if missing:
+                raise ValueError("No scale/offset of bands " + str(missing))
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        data = data.reshape((-1,) + self.shape)
+        n = len(data)
+        if masks is None:
+            masks = np.zeros((n,) + self.shape[:2], dtype=bool)
+        masks = np.ascontiguousarray(masks, dtype=bool)
+        masks = masks.reshape((n,) + self.shape[:2])
+        if n == 0:
+            return
+
+        if self.files is None:
+            self.open_files()
+        for output, array in zip(self.files, (data, masks)):
+            output.write(array.tobytes())
+            output.flush()
+
+        rows = []
+        for i in range(n):
+            lon, lat = (None, None) if centroids is None else centroids[i]
+            rows.append(
+                (
+                    self.count + i,
+                    None if names is None else names[i],
+                    None if timestamp is None else str(timestamp),
+                    band,
+                    lon,
+                    lat,
+                    file,
+                )
+            )
+        self.conn.executemany(
+            "INSERT INTO patches VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.conn.commit()
+        self.count += n
+        self.maps = None
+
+    def truncate(self, count):
+        """This method drops the patches after the first count ones."""
+        if count >= self.count:
+            return
+        self.conn.execute("DELETE FROM patches WHERE id >= ?", (count,))
+        self.conn.commit()
+        self.count = count
+        self.maps = None
+        # Arrays are truncated when (re)opened to append
+        if self.files is not None:
+            for output in self.files:
+                output.close()
+            self.files = None
+
+    def get_maps(self):
+        """This method memory-maps the patches and masks committed so far."""
+        if self.maps is None or len(self.maps[0]) != self.count:
+            if self.count == 0:
+                return (
+                    np.empty((0,) + self.shape, dtype=self.dtype),
+                    np.empty((0,) + self.shape[:2], dtype=bool),
+                )
+            self.maps = tuple(
+                np.memmap(
+                    os.path.join(self.path, name),
+                    dtype=dtype,
+                    mode="r",
+                    shape=(self.count,) + shape,
+                )
+                for name, dtype, shape in (
+                    (DATA[self.dtype], self.dtype, self.shape),
+                    (MASKS, bool, self.shape[:2]),
+                )
+            )
+        return self.maps
+
+    @property
+    def data(self):
+        """
+        Patches, (N,) + shape shaped (memory-mapped, read-only, as stored:
+        see decode).
+        """
+        return self.get_maps()[0]
+
+    @property
+    def masks(self):
+        """Masks, (N, lines, columns) shaped (memory-mapped, read-only)."""
+        return self.get_maps()[1]
+
+    def decode(self, ids):
+        """
+        This method returns the patches ids (indexes, an array or a slice)
+        as float32 arrays: a copy of float32 patches or the values of counts
+        (NODATA where there is no data, normalized or not).
+        """
+        if isinstance(ids, slice):
+            ids = np.arange(self.count)[ids]
+        data = np.asarray(self.data[ids])
+        if self.dtype == "float32":
+            return np.array(data)
+
+        values = np.empty(data.shape, dtype=np.float32)
+        bands = np.array([row[3] for row in self.metadata(np.ravel(ids))])
+        bands = bands.reshape(np.shape(ids))
+        for band in np.unique(bands):
+            scale, offset = np.array(
+                [self.scaling[b] for b in band.split(",")], dtype=np.float32
+            ).T
+            if len(self.shape) == 2:
+                scale, offset = scale[0], offset[0]
+            selected = bands == band
+            values[selected] = data[selected] * scale + offset
+        values[data == COUNT_NODATA] = NODATA
+        return values
+
+    def masked(self, ids):
+        """This method returns the patches ids (decoded) as masked arrays."""
+        data = self.decode(ids)
+        masks = self.masks[ids]
+        masks = masks.reshape(masks.shape + (1,) * (len(self.shape) - 2))
+        return np.ma.array(data, mask=np.broadcast_to(masks, data.shape))
+
+    def query(self, where="1", params=()):
+        """
+        This method returns the ids of the patches whose metadata matches
+        the SQL condition where (e.g. "band = ?").
+        """
+        sql = "SELECT id FROM patches WHERE " + where + " ORDER BY id"
+        return np.array(
+            [i for i, in self.conn.execute(sql, params)], dtype=np.int64
+        )
+
+    def get_bands(self):
+        """This method returns the distinct bands of the patches."""
+        sql = "SELECT DISTINCT band FROM patches ORDER BY band"
+        return [band for band, in self.conn.execute(sql)]
+
+    def metadata(self, ids=None):
+        """This method returns the metadata rows of the patches ids."""
+        sql = "SELECT id, name, timestamp, band, lon, lat, file FROM patches"
+        if ids is None:
+            return self.conn.execute(sql + " ORDER BY id").fetchall()
+        if len(ids) == 0:
+            return []
+        rows = self.conn.execute(
+            sql + " WHERE id BETWEEN ? AND ?", (int(min(ids)), int(max(ids)))
+        )
+        rows = {row[0]: row for row in rows}
+        return [rows[i] for i in ids]
+
+    def close(self):
+        """This method closes the store."""
+        if self.files is not None:
+            for output in self.files:
+                output.close()
+            self.files = None
+        self.maps = None
+        self.conn.close()
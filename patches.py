@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# Cutting patches from remapped grids with plain array slicing, replacing a
+# gdal.Translate (dataset + GeoTIFF in /vsimem) per patch. The grid is read
+# into an array once; system bounds become line/column offsets through the
+# geotransform. System patches are centred and written straight into
+# preallocated (N, size, size) buffers.
+
+import numpy as np
+
+from remap_g16 import NODATA
+
+
+# Rounds of candidate windows drawn by sample_windows
+SAMPLE_ROUNDS = 8
+
+
+def copy_window(array, line0, col0, step, out):
+    """
+    This function copies the pixels array[line0 + step * i, col0 + step * j]
+    into out[i, j], only where they fall inside array (the others are left
+    unchanged).
+    """
+    size0, size1 = out.shape[:2]
+    nlines, ncols = array.shape[:2]
+    # Range of out lines/columns inside array
+    i0, j0 = max(0, -(line0 // step)), max(0, -(col0 // step))
+    i1 = min(size0, -((line0 - nlines) // step))
+    j1 = min(size1, -((col0 - ncols) // step))
+    if i0 >= i1 or j0 >= j1:
+        return
+    out[i0:i1, j0:j1] = array[
+        line0 + step * i0 : line0 + step * (i1 - 1) + 1 : step,
+        col0 + step * j0 : col0 + step * (j1 - 1) + 1 : step,
+    ]
+
+
+def get_outside(s):
+    """
+    This function returns the pixels of a system raster outside the system
+    (nodata, which is NaN for grids without a nodata value).
+    """
+    if s.nodata is None or np.isnan(s.nodata):
+        return np.isnan(s.raster)
+    return s.raster == s.nodata
+
+
+def build_patches(
+    grid, geotransform, systems, sizearray=150, oversize="crop", nodata=NODATA
+):
+    """
+    This function cuts a sizearray x sizearray patch of grid, (lines,
+    columns) or (lines, columns, bands) shaped, centred on each system,
+    writing them into preallocated buffers. Systems larger than the patch
+    are cropped around their centre (oversize = "crop") or decimated to fit
+    it (oversize = "downsample").
+
+    Returning the patches, their masks (True outside the systems) and the
+    number of oversize systems
+    """
+    if oversize not in ("crop", "downsample"):
+        raise ValueError("Unknown oversize mode: " + str(oversize))
+
+    n = len(systems)
+    data = np.full(
+        (n, sizearray, sizearray) + grid.shape[2:], nodata, dtype=grid.dtype
+    )
+    mask = np.ones((n, sizearray, sizearray), dtype=bool)
+    count = 0
+    for i, s in enumerate(systems):
+        nlines, ncols = s.raster.shape
+        step = 1
+        if max(nlines, ncols) > sizearray:
+            count += 1
+            if oversize == "downsample":
+                step = -(-max(nlines, ncols) // sizearray)
+
+        # Patch origin relative to the system raster, centring it
+        top = (nlines - sizearray * step) // 2
+        left = (ncols - sizearray * step) // 2
+
+        # System raster origin in the grid
+        gt = s.geotransform
+        line = int(round((gt[3] - geotransform[3]) / geotransform[5]))
+        col = int(round((gt[0] - geotransform[0]) / geotransform[1]))
+
+        copy_window(grid, line + top, col + left, step, data[i])
+        copy_window(get_outside(s), top, left, step, mask[i])
+
+    return data, mask, count
+
+
+def get_boxes(systems, geotransform):
+    """
+    This function returns the windows (line0, line1, col0, col1) of the
+    system rasters in a grid.
+    """
+    boxes = np.empty((len(systems), 4), dtype=np.int64)
+    for i, s in enumerate(systems):
+        gt = s.geotransform
+        line = int(round((gt[3] - geotransform[3]) / geotransform[5]))
+        col = int(round((gt[0] - geotransform[0]) / geotransform[1]))
+        nlines, ncols = s.raster.shape
+        boxes[i] = line, line + nlines, col, col + ncols
+    return boxes
+
+
+def sample_windows(
+    shape, sizearray, samples, boxes=None, candidates=4, rounds=SAMPLE_ROUNDS
+):
+    """
+    This function draws samples non-overlapping sizearray x sizearray
+    windows inside a grid of the given shape, rejecting the ones that
+    intersect boxes (e.g. of tracked systems, see get_boxes). Candidate
+    windows (samples * candidates per round) are drawn and tested all
+    together, in up to rounds rounds; if fewer windows are found (e.g. a
+    grid crowded with systems), the shortfall is reported.
+
+    Returning the upper-left lines and columns of the windows
+    """
+    nlines, ncols = shape[:2]
+    n = samples * candidates
+    chosen_lines = np.empty(0, dtype=np.int64)
+    chosen_cols = np.empty(0, dtype=np.int64)
+    for _ in range(rounds):
+        if len(chosen_lines) >= samples:
+            break
+        lines = np.random.randint(0, nlines - sizearray + 1, n)
+        cols = np.random.randint(0, ncols - sizearray + 1, n)
+
+        # Box intersection test of all (candidate, box) pairs
+        if boxes is not None and len(boxes) > 0:
+            hits = (
+                (lines[:, None] < boxes[None, :, 1])
+                & (lines[:, None] + sizearray > boxes[None, :, 0])
+                & (cols[:, None] < boxes[None, :, 3])
+                & (cols[:, None] + sizearray > boxes[None, :, 2])
+            )
+            free = ~hits.any(axis=1)
+            lines, cols = lines[free], cols[free]
+
+        # Candidates overlapping the windows of previous rounds
+        overlap = (
+            np.abs(lines[:, None] - chosen_lines[None, :]) < sizearray
+        ) & (np.abs(cols[:, None] - chosen_cols[None, :]) < sizearray)
+        free = ~overlap.any(axis=1)
+
+        # Keep candidates (in drawing order) not overlapping the ones kept
+        overlap = (np.abs(lines[:, None] - lines[None, :]) < sizearray) & (
+            np.abs(cols[:, None] - cols[None, :]) < sizearray
+        )
+        chosen = []
+        for i in range(len(lines)):
+            if len(chosen_lines) + len(chosen) == samples:
+                break
+            if free[i]:
+                chosen.append(i)
+                free &= ~overlap[i]
+
+        chosen_lines = np.concatenate([chosen_lines, lines[chosen]])
+        chosen_cols = np.concatenate([chosen_cols, cols[chosen]])
+
+    if len(chosen_lines) < samples:
+        print(
+            "* Only", len(chosen_lines), "of", samples, "windows sampled"
+        )
+    return chosen_lines, chosen_cols
+
+
+def cut_windows(grid, lines, cols, sizearray):
+    """
+    This function copies the sizearray x sizearray windows of grid,
+    (lines, columns) or (lines, columns, bands) shaped, with the given
+    upper-left lines and columns, in a single gather.
+
+    Returning a (N, sizearray, sizearray[, bands]) array
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(
+        grid, (sizearray, sizearray), axis=(0, 1)
+    )
+    windows = windows[lines, cols]
+    if grid.ndim == 3:
+        # (N, bands, lines, columns) to (N, lines, columns, bands)
+        windows = np.moveaxis(windows, 1, -1)
+    return windows
@@ -1,101 +1,131 @@
 # -*- coding: utf-8 -*-
 # Normalizing arrays values according to satellite band
 
-from glob import glob
-import pickle
+import configparser
+import itertools
+import os
 
 import numpy as np
-from sklearn.preprocessing import MinMaxScaler
-
-
-# Opening pickles
-files = glob(
-    "misc/term_project-aga5926/data/imgs_*.pickle"
-)
-# print(files)
-
-with open(files[0], "rb") as input:
-    imgs_random_band = pickle.load(input)
-imgs_random_band = [item for sublist in imgs_random_band for item in sublist]
-with open(files[1], "rb") as input:
-    imgs_band = pickle.load(input)
-imgs_band = [item for sublist in imgs_band for item in sublist]
-with open(files[2], "rb") as input:
-    imgs_mask = pickle.load(input)
-imgs_mask = [item for sublist in imgs_mask for item in sublist]
-with open(files[3], "rb") as input:
-    imgs_nomask = pickle.load(input)
-imgs_nomask = [item for sublist in imgs_nomask for item in sublist]
-with open(files[4], "rb") as input:
-    imgs_random = pickle.load(input)
-imgs_random = [item for sublist in imgs_random for item in sublist]
+
+from manifest import Manifest, read_manifest
+from patch_store import NODATA, PatchStore
+
+
+def get_ranges(config):
+    """
+    This function reads the value ranges of each band.
+
+    Returning a dict {band: (min, max)}
+    """
+    ranges = {}
+    for key, value in config.items("Normalization"):
+        # Band options (e.g. C13, lowercased by configparser)
+        if key.startswith("c") and key[1:].isdigit():
+            ranges[key.upper()] = tuple(float(i) for i in value.split(","))
+    return ranges
+
+
+def normalize(data, band, ranges):
+    """
+    This function scales in place data, (N, lines, columns, channels)
+    shaped, from the ranges of its bands (band, one per channel, separated
+    by commas) to [0, 1]. Pixels without data are kept as NODATA, as
+    PatchStore.decode gives for counts.
+    """
+    nodata = data == NODATA
+    lo, hi = np.array([ranges[b] for b in band.split(",")]).T
+    data -= lo.astype(data.dtype)
+    data *= (1.0 / (hi - lo)).astype(data.dtype)
+    data[nodata] = NODATA
+
+
+def normalize_scaling(scaling, ranges):
+    """
+    This function returns the scale and offset of counts ({band: (scale,
+    offset)}) that give values already normalized by the ranges of their
+    bands.
+    """
+    normalized = {}
+    for band, (scale, offset) in scaling.items():
+        lo, hi = ranges[band]
+        normalized[band] = (scale / (hi - lo), (offset - lo) / (hi - lo))
+    return normalized
+
+
+def normalize_store(source, target, ranges, chunksize=256, first=0):
+    """
+    This function normalizes the patches of a store (from the first one)
+    into another one, in the same order and with the same masks and
+    metadata, chunk by chunk, according to the band of each patch (one band
+    per channel for stacked patches). Counts (uint16 stores) are copied as
+    they are, only their scale and offset are normalized.
+    """
+    scaling = None
+    if source.dtype == "uint16":
+        scaling = normalize_scaling(source.scaling, ranges)
+    for start in range(first, len(source), chunksize):
+        chunk = np.arange(start, min(start + chunksize, len(source)))
+        data = np.array(source.data[chunk])
+        data = data.reshape(data.shape[:3] + (-1,))
+        masks = source.masks[chunk]
+        rows = source.metadata(chunk)
+
+        # Patches of the same timestamp/band/file are processed together
+        groups = itertools.groupby(
+            range(len(chunk)),
+            key=lambda j: (rows[j][2], rows[j][3], rows[j][6]),
+        )
+        for (timestamp, band, file), group in groups:
+            group = list(group)
+            block = data[group[0] : group[-1] + 1]
+            if scaling is None:
+                normalize(block, band, ranges)
+            target.append(
+                block,
+                masks[group[0] : group[-1] + 1],
+                [rows[j][1] for j in group],
+                timestamp,
+                band,
+                [(rows[j][4], rows[j][5]) for j in group],
+                file,
+                scaling,
+            )
+
 
 # Normalize values according to band
-ranges = {
-    "C02": np.full((150, 150), np.repeat([0.0, 1.3], 75)).transpose(),
-    "C11": np.full((150, 150), np.repeat([127.69, 341.30], 75)).transpose(),
-    "C13": np.full((150, 150), np.repeat([89.62, 341.27], 75)).transpose(),
-    "C14": np.full((150, 150), np.repeat([96.19, 341.28], 75)).transpose(),
-    "C15": np.full((150, 150), np.repeat([97.38, 341.28], 75)).transpose(),
-}
-
-# Testing function
-# scaler = MinMaxScaler(copy=False)
-# test = scaler.fit(ranges["C02"])
-# print(scaler.data_min_)
-# test2 = scaler.transform(np.array([0.1, 0.5, 1, 0.0, 1.3]).reshape(-1, 1))
-# print(test2)
-
-# Masked/unmasked images
-norm_mask = []
-norm_nomask = []
-for i in range(len(imgs_band)):
-    # Get band
-    band = imgs_band[i]
-    # Create scaler for normalization
-    scaler = MinMaxScaler(copy=False)
-    model_fit = scaler.fit(ranges[band])
-    # Check if shape is valid, skip if isn't
-    if imgs_mask[i].shape == (150, 150):
-        # Transform data
-        norm_mask.append(scaler.transform(imgs_mask[i]))
-    # Check if shape is valid, skip if isn't
-    if imgs_nomask[i].shape == (150, 150):
-        # Transform data
-        norm_nomask.append(scaler.transform(imgs_nomask[i]))
-    del scaler, model_fit
-# Add in pickle
-with open(
-    "misc/term_project-aga5926/data/norm_mask.pickle",
-    "wb",
-) as output:
-    pickle.dump(norm_mask, output, pickle.HIGHEST_PROTOCOL)
-with open(
-    "misc/term_project-aga5926/data/norm_nomask.pickle",
-    "wb",
-) as output:
-    pickle.dump(norm_nomask, output, pickle.HIGHEST_PROTOCOL)
-
-print("Masked/unmasked images done!")
-
-# Random images
-norm_random = []
-for i in range(len(imgs_random_band)):
-    # Get band
-    band = imgs_random_band[i]
-    # Create scaler for normalization
-    scaler = MinMaxScaler(copy=False)
-    model_fit = scaler.fit(ranges[band])
-    # Check if shape is valid, skip if isn't
-    if imgs_random[i].shape == (150, 150):
-        # Transform data
-        norm_random.append(scaler.transform(imgs_random[i]))
-    del scaler, model_fit
-# Add in pickle
-with open(
-    "misc/term_project-aga5926/data/norm_random.pickle",
-    "wb",
-) as output:
-    pickle.dump(norm_random, output, pickle.HIGHEST_PROTOCOL)
-print("Random images done!")
+config = configparser.ConfigParser()
+config.read("config-dataset.ini")
+ranges = get_ranges(config)
+chunksize = config.getint("Normalization", "chunksize")
+
+# Stores written by mask_systems.py/get_random_g16_samples.py
+datadir = "misc/term_project-aga5926/data/"
+for name in ["systems", "random", "stacked", "random_stacked"]:
+    if not os.path.exists(datadir + name):
+        continue
+    source = PatchStore(datadir + name)
+    target = PatchStore(
+        datadir + "norm_" + name, source.shape, source.dtype
+    )
+
+    # Only patches appended to the source since the last run are
+    # normalized; everything if the ranges changed or the source was built
+    # again (new manifest id)
+    parameters = {
+        "ranges": ranges,
+        "source": read_manifest(source.path).get("id"),
+    }
+    manifest = Manifest(target.path, "normalization", parameters)
+    if len(target) < manifest.count or len(source) < manifest.count:
+        manifest.reset()
+    target.truncate(manifest.count)
 
+    if len(target) == len(source):
+        print("Skipping already normalized images:", name)
+    else:
+        normalize_store(source, target, ranges, chunksize, len(target))
+        manifest.add([], len(target))
+        manifest.close()
+        print(name.capitalize(), "images done!", len(target))
+    source.close()
+    target.close()
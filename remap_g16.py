@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+
+# Remapping GOES-16 ABI fixed grid data to a regular lat/lon grid.
+# The nearest-neighbour correspondence between the two grids never changes,
+# so it is computed once, persisted as a lookup table (LUT) and reused for
+# every file: remapping a frame becomes a read of the fixed grid window that
+# covers the grid followed by a single vectorized gather. Remapped grids can
+# also be kept in a disk cache (compressed tiled GeoTIFFs), shared by the
+# tracking and dataset scripts, so reruns skip the remap entirely.
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+from netCDF4 import Dataset
+from osgeo import gdal
+
+from tathu.constants import KM_PER_DEGREE
+
+
+# Value assigned to grid pixels without valid data
+NODATA = -1
+
+# Value assigned to count grid pixels (uint16) without valid data
+COUNT_NODATA = 65535
+
+# Number of grid lines computed at once when building a LUT
+LUT_BLOCK_LINES = 256
+
+# Source pixels added around the window read from files
+WINDOW_MARGIN = 2
+
+# Creation options of cached grids (plus the predictor of the data type)
+CACHE_OPTIONS = [
+    "TILED=YES",
+    "BLOCKXSIZE=256",
+    "BLOCKYSIZE=256",
+    "COMPRESS=DEFLATE",
+]
+
+# LUTs already loaded by this process (shared by its threads), each one
+# loaded under its own lock
+_luts = {}
+_locks = {}
+_lock = threading.Lock()
+
+
+def get_grid_size(extent, resolution):
+    """This function returns the grid dimension (columns, lines)."""
+    sizex = int(((extent[2] - extent[0]) * KM_PER_DEGREE) / resolution)
+    sizey = int(((extent[3] - extent[1]) * KM_PER_DEGREE) / resolution)
+    return sizex, sizey
+
+
+def get_geotransform(extent, nlines, ncols):
+    """This function returns the geotransform of a regular grid."""
+    resx = (extent[2] - extent[0]) / ncols
+    resy = (extent[3] - extent[1]) / nlines
+    return [extent[0], resx, 0.0, extent[3], 0.0, -resy]
+
+
+def read_coordinate(var):
+    """
+    This function returns the first value and the step (radians) of an ABI
+    fixed grid coordinate variable, computed in double precision.
+    """
+    var.set_auto_maskandscale(False)
+    first = float(var[0])
+    scale = float(var.scale_factor)
+    offset = float(var.add_offset)
+    return first * scale + offset, scale
+
+
+def read_fixed_grid(nc, var="CMI"):
+    """
+    This function reads the ABI fixed grid definition of an opened file.
+
+    Returning a tuple that fully identifies the source grid
+    """
+    proj = nc.variables["goes_imager_projection"]
+    x0, dx = read_coordinate(nc.variables["x"])
+    y0, dy = read_coordinate(nc.variables["y"])
+    nlines, ncols = nc.variables[var].shape
+    return (
+        float(proj.perspective_point_height),
+        float(proj.semi_major_axis),
+        float(proj.semi_minor_axis),
+        float(proj.longitude_of_projection_origin),
+        x0,
+        dx,
+        y0,
+        dy,
+        nlines,
+        ncols,
+    )
+
+
+def get_lut_key(fixedgrid, extent, resolution, targetPrj):
+    """This function returns the key that identifies a LUT."""
+    key = repr(
+        (
+            fixedgrid,
+            [float(i) for i in extent],
+            float(resolution),
+            targetPrj.ExportToWkt(),
+        )
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def latlon2fixedgrid(lat, lon, fixedgrid):
+    """
+    This function converts geodetic lat/lon (radians) to ABI fixed grid
+    scan angles (radians), following the GOES-R PUG navigation equations.
+
+    Returning x, y and a flag of points visible from the satellite
+    """
+    h, a, b, lon0 = fixedgrid[:4]
+    h = h + a
+    # Geocentric latitude and distance to the Earth center
+    e2 = (a * a - b * b) / (a * a)
+    latc = np.arctan((b * b) / (a * a) * np.tan(lat))
+    rc = b / np.sqrt(1.0 - e2 * np.cos(latc) ** 2)
+    # Satellite-point vector
+    sx = h - rc * np.cos(latc) * np.cos(lon - np.radians(lon0))
+    sy = -rc * np.cos(latc) * np.sin(lon - np.radians(lon0))
+    sz = rc * np.sin(latc)
+    visible = h * (h - sx) >= sy * sy + (a * a) / (b * b) * sz * sz
+    x = np.arcsin(-sy / np.sqrt(sx * sx + sy * sy + sz * sz))
+    y = np.arctan(sz / sx)
+    return x, y, visible
+
+
+def compute_lut(fixedgrid, extent, resolution):
+    """
+    This function computes, for each grid pixel, the flat index of the
+    nearest source pixel (-1 if there is none).
+    """
+    x0, dx, y0, dy, nlines, ncols = fixedgrid[4:]
+    sizex, sizey = get_grid_size(extent, resolution)
+    gt = get_geotransform(extent, sizey, sizex)
+
+    # Pixel centers
+    lons = np.radians(gt[0] + gt[1] * (np.arange(sizex) + 0.5))
+    lats = np.radians(gt[3] + gt[5] * (np.arange(sizey) + 0.5))
+
+    index = np.full((sizey, sizex), -1, dtype=np.int32)
+    for start in range(0, sizey, LUT_BLOCK_LINES):
+        lon, lat = np.meshgrid(lons, lats[start : start + LUT_BLOCK_LINES])
+        x, y, visible = latlon2fixedgrid(lat, lon, fixedgrid)
+        # Source pixel containing each center (coordinates are at centers)
+        cols = np.floor((x - x0) / dx + 0.5)
+        rows = np.floor((y - y0) / dy + 0.5)
+        valid = (
+            visible
+            & (cols >= 0)
+            & (cols < ncols)
+            & (rows >= 0)
+            & (rows < nlines)
+        )
+        block = index[start : start + LUT_BLOCK_LINES]
+        block[valid] = rows[valid] * ncols + cols[valid]
+
+    return index
+
+
+def get_window(index, nlines, ncols, margin=WINDOW_MARGIN):
+    """
+    This function computes the source window (hyperslab) that covers a LUT
+    and converts the LUT to flat indexes inside that window.
+
+    Returning the new index and the window (line0, line1, col0, col1)
+    """
+    valid = index >= 0
+    if not valid.any():
+        return index, (0, 0, 0, 0)
+
+    lines, cols = np.divmod(index[valid], ncols)
+    line0 = max(int(lines.min()) - margin, 0)
+    line1 = min(int(lines.max()) + 1 + margin, nlines)
+    col0 = max(int(cols.min()) - margin, 0)
+    col1 = min(int(cols.max()) + 1 + margin, ncols)
+
+    window = np.full(index.shape, -1, dtype=np.int32)
+    window[valid] = (lines - line0) * (col1 - col0) + (cols - col0)
+
+    return window, (line0, line1, col0, col1)
+
+
+def get_lut(fixedgrid, extent, resolution, targetPrj, lutdir):
+    """
+    This function returns the LUT of the given setup, loading it from
+    lutdir or computing (and saving) it when necessary.
+
+    Returning the LUT, relative to the source window, and the window
+    """
+    if not targetPrj.IsGeographic():
+        raise ValueError("Remapping LUTs support lat/lon grids only")
+
+    key = get_lut_key(fixedgrid, extent, resolution, targetPrj)
+    with _lock:
+        lock = _locks.setdefault(key, threading.Lock())
+    with lock:
+        if key not in _luts:
+            _luts[key] = load_lut(key, fixedgrid, extent, resolution, lutdir)
+    return _luts[key]
+
+
+def load_lut(key, fixedgrid, extent, resolution, lutdir):
+    """This function loads (computing, if necessary) the LUT of key."""
+    path = os.path.join(lutdir, "lut-" + key + ".npy")
+    if not os.path.exists(path):
+        print("Computing remapping LUT", path)
+        index = compute_lut(fixedgrid, extent, resolution)
+        # Write to a temporary file first, other processes may be reading
+        os.makedirs(lutdir, exist_ok=True)
+        tmp = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, "wb") as output:
+            np.save(output, index)
+        os.replace(tmp, path)
+
+    nlines, ncols = fixedgrid[-2:]
+    return get_window(np.load(path), nlines, ncols)
+
+
+def apply_lut(data, index):
+    """This function gathers source data into the grid defined by index."""
+    data = np.ma.filled(np.ma.asarray(data, dtype=np.float32), NODATA)
+    array = np.take(data.ravel(), index)
+    array[index < 0] = NODATA
+    return array
+
+
+def apply_counts(data, index, fill=None):
+    """
+    This function gathers the scaled integer counts of source data (as
+    stored, unsigned) into the grid defined by index.
+    """
+    data = np.asarray(data)
+    counts = data.astype(np.uint16)
+    if fill is not None:
+        counts[data == fill] = COUNT_NODATA
+    array = np.take(counts.ravel(), index)
+    array[index < 0] = COUNT_NODATA
+    return array
+
+
+def array2grid(array, extent, targetPrj):
+    """
+    This function creates a GDAL in-memory grid from an array, (lines,
+    columns) or (bands, lines, columns) shaped.
+    """
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    nbands, nlines, ncols = array.shape
+    memDriver = gdal.GetDriverByName("MEM")
+    grid = memDriver.Create("grid", ncols, nlines, nbands, gdal.GDT_Float32)
+    grid.SetProjection(targetPrj.ExportToWkt())
+    grid.SetGeoTransform(get_geotransform(extent, nlines, ncols))
+    for i in range(nbands):
+        grid.GetRasterBand(i + 1).SetNoDataValue(NODATA)
+        grid.GetRasterBand(i + 1).WriteArray(array[i])
+    return grid
+
+
+def get_cache_key(
+    path, extent, resolution, targetPrj, var="CMI", counts=False
+):
+    """
+    This function returns the key of a remapped grid in the cache: source
+    file (name, which includes the band, size and modification time),
+    variable, extent, resolution, projection and kind of values (counts or
+    physical values).
+    """
+    stat = os.stat(path)
+    key = repr(
+        (
+            os.path.basename(path),
+            stat.st_size,
+            stat.st_mtime,
+            var,
+            [float(i) for i in extent],
+            float(resolution),
+            targetPrj.ExportToWkt(),
+            bool(counts),
+        )
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def read_cached(path):
+    """
+    This function reads a cached grid, marking it as recently used.
+
+    Returning the grid array, scale and offset or None, if it is not cached
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        dataset = gdal.Open(path)
+    except RuntimeError:
+        # Evicted meanwhile
+        return None
+    if dataset is None:
+        return None
+    band = dataset.GetRasterBand(1)
+    array = band.ReadAsArray()
+    scale = band.GetScale() or 1.0
+    offset = band.GetOffset() or 0.0
+    dataset = None
+    try:
+        os.utime(path)
+    except OSError:
+        # Evicted meanwhile
+        pass
+    return array, scale, offset
+
+
+def write_cached(path, array, extent, targetPrj, scale=1.0, offset=0.0):
+    """
+    This function writes a grid (float32 values or uint16 counts, with
+    their scale and offset) to the cache (atomically).
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + "." + str(os.getpid()) + "." + str(threading.get_ident())
+    driver = gdal.GetDriverByName("GTiff")
+    nlines, ncols = array.shape
+    if array.dtype == np.uint16:
+        dtype, nodata, predictor = gdal.GDT_UInt16, COUNT_NODATA, 2
+    else:
+        dtype, nodata, predictor = gdal.GDT_Float32, NODATA, 3
+    dataset = driver.Create(
+        tmp,
+        ncols,
+        nlines,
+        1,
+        dtype,
+        CACHE_OPTIONS + ["PREDICTOR=" + str(predictor)],
+    )
+    dataset.SetProjection(targetPrj.ExportToWkt())
+    dataset.SetGeoTransform(get_geotransform(extent, nlines, ncols))
+    band = dataset.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.SetScale(scale)
+    band.SetOffset(offset)
+    band.WriteArray(array)
+    dataset = None
+    os.replace(tmp, path)
+
+
+def evict(cachedir, cachesize):
+    """
+    This function removes the least recently used grids of the cache until
+    its size is at most cachesize (MB).
+    """
+    entries = []
+    total = 0
+    for entry in os.scandir(cachedir):
+        if not entry.name.endswith(".tif"):
+            continue
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    entries.sort()
+    limit = cachesize * 1024 * 1024
+    for _, size, path in entries:
+        if total <= limit:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed by another process or still opened
+            continue
+        total -= size
+
+
+def read_window(
+    path, extent, resolution, targetPrj, lutdir, var="CMI", counts=False
+):
+    """
+    This function reads the window of the fixed grid of a GOES-16 file that
+    covers the LUT of the given grid (only that hyperslab is read). Unless
+    counts are requested, scale, offset and fill values are applied by
+    netCDF4.
+
+    Returning the window data, the LUT relative to it and the scale, offset
+    and fill value of counts
+    """
+    nc = Dataset(path, "r")
+    try:
+        fixedgrid = read_fixed_grid(nc, var)
+        index, window = get_lut(
+            fixedgrid, extent, resolution, targetPrj, lutdir
+        )
+        line0, line1, col0, col1 = window
+        variable = nc.variables[var]
+        scale, offset, fill = 1.0, 0.0, None
+        if counts:
+            variable.set_auto_maskandscale(False)
+            scale = float(getattr(variable, "scale_factor", 1.0))
+            offset = float(getattr(variable, "add_offset", 0.0))
+            fill = getattr(variable, "_FillValue", None)
+        data = variable[line0:line1, col0:col1]
+    finally:
+        nc.close()
+
+    return data, index, scale, offset, fill
+
+
+def remap_grid(
+    path,
+    extent,
+    resolution,
+    targetPrj,
+    lutdir,
+    var="CMI",
+    cachedir=None,
+    cachesize=2048,
+    counts=False,
+):
+    """
+    This function remaps a GOES-16 file to a regular lat/lon grid, as
+    goes16.sat2grid (nearest neighbour), reusing the LUT of lutdir. Only the
+    window of the fixed grid that covers the extent is read from the file.
+    If cachedir is given, the grid is read from/saved to the cache of
+    remapped grids, limited to cachesize (MB).
+
+    The grid has physical values (float32, NODATA where there is no data)
+    or, if counts, the scaled integer counts of the file (uint16,
+    COUNT_NODATA where there is no data), which are converted to physical
+    values by counts * scale + offset.
+
+    Returning the grid array, scale and offset
+    """
+    if cachedir:
+        key = get_cache_key(path, extent, resolution, targetPrj, var, counts)
+        cached = os.path.join(cachedir, key + ".tif")
+        result = read_cached(cached)
+        if result is not None:
+            return result
+
+    data, index, scale, offset, fill = read_window(
+        path, extent, resolution, targetPrj, lutdir, var, counts
+    )
+    if counts:
+        array = apply_counts(data, index, fill)
+    else:
+        array = apply_lut(data, index)
+    if cachedir:
+        write_cached(cached, array, extent, targetPrj, scale, offset)
+        evict(cachedir, cachesize)
+    return array, scale, offset
+
+
+def read_source(path, extent, resolution, targetPrj, lutdir, var="CMI"):
+    """
+    This function reads the window of a GOES-16 file covered by the LUT of
+    the given grid (see read_window), without remapping it: any part of the
+    grid is then gathered with apply_lut(data, index[lines, columns]).
+
+    Returning the window data (float32, NODATA where there is no data) and
+    the LUT relative to it
+    """
+    data, index = read_window(
+        path, extent, resolution, targetPrj, lutdir, var
+    )[:2]
+    return np.ma.filled(np.ma.asarray(data, dtype=np.float32), NODATA), index
+
+
+def remap_array(
+    path,
+    extent,
+    resolution,
+    targetPrj,
+    lutdir,
+    var="CMI",
+    cachedir=None,
+    cachesize=2048,
+):
+    """
+    This function remaps a GOES-16 file (see remap_grid).
+
+    Returning the grid array (float32)
+    """
+    return remap_grid(
+        path, extent, resolution, targetPrj, lutdir, var, cachedir, cachesize
+    )[0]
+
+
+def remap(
+    path,
+    extent,
+    resolution,
+    targetPrj,
+    lutdir,
+    var="CMI",
+    cachedir=None,
+    cachesize=2048,
+):
+    """
+    This function remaps a GOES-16 file (see remap_grid).
+
+    Returning a GDAL in-memory grid
+    """
+    array = remap_array(
+        path, extent, resolution, targetPrj, lutdir, var, cachedir, cachesize
+    )
+    return array2grid(array, extent, targetPrj)
@@ -21,11 +21,14 @@ __author__ = "Douglas Uba"
 __email__ = "douglas.uba@inpe.br"
 
 import argparse
+import collections
 import configparser
 import datetime
-import glob
+import math
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 # Setup SpatiaLite extension
 os.environ["PATH"] = (
@@ -38,14 +41,25 @@ os.environ["PATH"] = (
 # Tathu imports
 from tathu.constants import KM_PER_DEGREE, LAT_LON_WGS84
 from tathu.io import spatialite
-from tathu.satellite import goes16
 from tathu.tracking import descriptors
 from tathu.tracking import detectors
-from tathu.utils import file2timestamp, Timer
+from tathu.utils import Timer
 from tathu.tracking import trackers
 
 # Third-party imports
-from osgeo import gdal
+from osgeo import gdal, ogr
+
+# Local imports
+import catalog_g16
+import detection
+import overlap
+import remap_g16
+from output import BackgroundOutputter, OutputError, Outputter
+from database import connect, discard_unchecked, merge_shards
+
+
+# Attempts to read an image in watch mode before skipping it
+RETRIES = 3
 
 
 def get_datetime(str):
@@ -67,43 +81,79 @@ def get_days(start, end):
     return days
 
 
-def get_files(basedir, days):
-    files = []
-    for d in days:
-        y = d.strftime("%Y")
-        jd = d.strftime("%j")
-        search = basedir + "OR_ABI-L2-CMIPF-M6C13_G16_*_c" + y + jd + "*.nc"
-        print("Searching files", search)
-        files += glob.glob(search)
-    return sorted(files)
-
-
-def extract_periods(files, timeout):
-    previous_time = None
-    result = []
-    period = []
-    for path in files:
-        # Get current date/time
-        current_time = file2timestamp(path, yearpos=59, format="%Y%j%H%M%S")
-
-        # Initialize, if necessary
-        if previous_time is None:
-            previous_time = current_time
-
-        # Compute elapsed time
-        elapsed_time = current_time - previous_time
-
-        if elapsed_time.seconds > timeout * 60:
-            result.append(period)
-            period = []
-            previous_time = None
-        else:
-            period.append(path)
-            previous_time = current_time
+def split_shards(periods, nshards):
+    """
+    This function splits periods into (at most) nshards chunks with similar
+    number of images. A chunk that starts in the middle of a period also
+    includes the last image of the previous chunk (overlap image), used to
+    stitch families across both chunks.
+
+    Returning a list of (periods, overlap) tuples
+    """
+    total = sum(len(period) for period in periods)
+    size = max(1, math.ceil(total / nshards))
+
+    shards = []
+    chunk = []
+    overlapped = False
+    count = 0
+    for period in periods:
+        i = 0
+        while i < len(period):
+            n = min(size - count, len(period) - i)
+            piece = period[i : i + n]
+            if i > 0 and count == 0:
+                piece = [period[i - 1]] + piece
+                overlapped = True
+            chunk.append(piece)
+            count += n
+            i += n
+            if count == size:
+                shards.append((chunk, overlapped))
+                chunk = []
+                overlapped = False
+                count = 0
+
+    if chunk:
+        shards.append((chunk, overlapped))
+
+    return shards
+
+
+def get_shard_name(database, shard):
+    """This function returns the database name of a shard."""
+    return os.path.splitext(database)[0] + "-shard%03d.sqlite" % shard
+
+
+def describe(
+    grid, threshold, minarea, stats, compute_cc, threshold_cc, minarea_cc
+):
+    """This function detects and describes systems with TATHU classes."""
+    # Create detector
+    detector = detectors.ThresholdDetector(
+        threshold, detectors.ThresholdOp.LESS_THAN, minarea
+    )
+
+    # Searching for systems
+    systems = detector.detect(grid)
+
+    # Create statistical descriptor
+    descriptor = descriptors.StatisticalDescriptor(
+        stats=stats, rasterOut=True
+    )
 
-    result.append(period)
+    # Describe systems (stats)
+    systems = descriptor.describe(grid, systems)
 
-    return result
+    if compute_cc:
+        # Create convective cell descriptor
+        descriptor = descriptors.ConvectiveCellsDescriptor(
+            threshold_cc, minarea_cc
+        )
+        # Describe systems (convective cell)
+        descriptor.describe(grid, systems)
+
+    return systems
 
 
 def detect(
@@ -116,49 +166,144 @@ def detect(
     compute_cc,
     threshold_cc,
     minarea_cc,
+    lutdir,
+    detector,
+    cachedir=None,
+    cachesize=2048,
 ):
     with Timer():
         # Extract file timestamp
-        timestamp = file2timestamp(path, yearpos=59, format="%Y%j%H%M%S")
+        timestamp = catalog_g16.get_timestamp(path)
 
         print("Searching for systems at:", timestamp)
 
-        # Remap channel to 2km
-        grid = goes16.sat2grid(
-            path, extent, resolution, LAT_LON_WGS84, "HDF5", progress=None
-        )
+        if detector == "coarse":
+            # Remap only the candidate regions of a coarse grid (no cache)
+            data, index = remap_g16.read_source(
+                path, extent, resolution, LAT_LON_WGS84, lutdir
+            )
+            systems = detection.detect_coarse(
+                data,
+                index,
+                remap_g16.get_geotransform(extent, *index.shape),
+                threshold,
+                minarea,
+                stats,
+                compute_cc,
+                threshold_cc,
+                minarea_cc,
+            )
+            for s in systems:
+                s.timestamp = timestamp
+            return systems
 
-        # Create detector
-        detector = detectors.ThresholdDetector(
-            threshold, detectors.ThresholdOp.LESS_THAN, minarea
+        # Remap channel to 2km
+        grid = remap_g16.remap(
+            path,
+            extent,
+            resolution,
+            LAT_LON_WGS84,
+            lutdir,
+            cachedir=cachedir,
+            cachesize=cachesize,
         )
 
-        # Searching for systems
-        systems = detector.detect(grid)
+        if detector == "label":
+            # Label, filter and describe all systems at once
+            systems = detection.detect(
+                grid,
+                threshold,
+                minarea,
+                stats,
+                compute_cc,
+                threshold_cc,
+                minarea_cc,
+            )
+        else:
+            systems = describe(
+                grid,
+                threshold,
+                minarea,
+                stats,
+                compute_cc,
+                threshold_cc,
+                minarea_cc,
+            )
 
         # Adjust timestamp
         for s in systems:
             s.timestamp = timestamp
 
-        # Create statistical descriptor
-        descriptor = descriptors.StatisticalDescriptor(
-            stats=stats, rasterOut=True
-        )
+        grid = None
 
-        # Describe systems (stats)
-        systems = descriptor.describe(grid, systems)
+        return systems
 
-        if compute_cc:
-            # Create convective cell descriptor
-            descriptor = descriptors.ConvectiveCellsDescriptor(
-                threshold_cc, minarea_cc
-            )
-            # Describe systems (convective cell)
-            descriptor.describe(grid, systems)
 
-        grid = None
+def pack(systems):
+    """
+    This function converts systems geometries to WKB, allowing to send them
+    between processes.
+    """
+    for s in systems:
+        s.geom = bytes(s.geom.ExportToWkb())
+    return systems
+
+
+def unpack(systems):
+    """This function restores systems geometries converted by pack()."""
+    for s in systems:
+        s.geom = ogr.CreateGeometryFromWkb(s.geom)
+        s.geom.AssignSpatialReference(LAT_LON_WGS84)
+    return systems
 
-        return systems
+
+def detect_packed(*args):
+    """This function runs detect() in a worker process."""
+    return pack(detect(*args))
+
+
+def get_result(path, future):
+    """
+    This function returns (path, systems) of a detection submitted to the
+    pool, with systems = None if it failed.
+    """
+    try:
+        return path, unpack(future.result())
+    except Exception as e:
+        print("* Skipping image:", path, e)
+        return path, None
+
+
+def detect_files(files, workers, prefetch, *args):
+    """
+    This generator detects systems of each file, yielding (path, systems)
+    in the same order of files. If workers > 1, upcoming files are detected
+    ahead in a process pool, keeping at most workers * prefetch files in
+    progress. Files that can't be read/detected are logged and yielded with
+    systems = None.
+    """
+    if workers <= 1:
+        for path in files:
+            try:
+                yield path, detect(path, *args)
+            except Exception as e:
+                print("* Skipping image:", path, e)
+                yield path, None
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+        try:
+            for path in files:
+                future = pool.submit(detect_packed, path, *args)
+                pending.append((path, future))
+                if len(pending) >= workers * prefetch:
+                    yield get_result(*pending.popleft())
+            while pending:
+                yield get_result(*pending.popleft())
+        finally:
+            for _, future in pending:
+                future.cancel()
 
 
 def track(
@@ -171,62 +316,226 @@ def track(
     compute_cc,
     threshold_cc,
     minarea_cc,
+    lutdir,
+    detector,
+    cachedir,
+    cachesize,
     areaoverlap,
+    timeout,
     outputter,
     current=None,
+    current_time=None,
+    workers=1,
+    prefetch=2,
+    strict=False,
 ):
+    """
+    This function tracks the systems of a period (files), continuing from
+    the current systems (detected at current_time), if given. Unreadable
+    images are skipped; gaps greater than timeout minutes start a new
+    period. A checkpoint is recorded after each image is written.
+    Unexpected errors end the period, and are raised if strict (e.g. a
+    shard, which must not be merged as if complete).
+    """
     try:
-        img = 0
-        if current is None:
-            # Detect first systems
-            current = detect(
-                files[img],
-                extent,
-                resolution,
-                threshold,
-                minarea,
-                stats,
-                compute_cc,
-                threshold_cc,
-                minarea_cc,
-            )
-            # Save to output
-            outputter.output(current)
-            img = img + 1
+        # Checkpoints are recorded per period, identified by its first image
+        period = catalog_g16.get_timestamp(files[0])
+
+        # Detect systems of each image file, in timestamp order
+        detected = detect_files(
+            files,
+            workers,
+            prefetch,
+            extent,
+            resolution,
+            threshold,
+            minarea,
+            stats,
+            compute_cc,
+            threshold_cc,
+            minarea_cc,
+            lutdir,
+            detector,
+            cachedir,
+            cachesize,
+        )
 
         # Prepare tracking...
         previous = current
+        previous_time = current_time
 
-        # Create overlap area strategy
-        strategy = trackers.RelativeOverlapAreaStrategy(areaoverlap)
+        # Create overlap area strategy, prefiltered by bounding boxes
+        strategy = overlap.IndexedOverlapStrategy(
+            trackers.RelativeOverlapAreaStrategy(areaoverlap)
+        )
 
         # for each image file
-        for i in range(img, len(files)):
-            # Detect current systems
-            current = detect(
-                files[i],
-                extent,
-                resolution,
-                threshold,
-                minarea,
-                stats,
-                compute_cc,
-                threshold_cc,
-                minarea_cc,
-            )
-
-            # Let's track!
-            t = trackers.OverlapAreaTracker(previous, strategy=strategy)
-            t.track(current)
+        for path, current in detected:
+            # Skipped image
+            if current is None:
+                continue
+
+            # Start a new period after gaps greater than timeout
+            timestamp = catalog_g16.get_timestamp(path)
+            if (
+                previous_time is not None
+                and (timestamp - previous_time).total_seconds() > timeout * 60
+            ):
+                print("Gap greater than timeout, new period at", timestamp)
+                previous = None
+
+            if previous is not None:
+                # Let's track!
+                strategy.index(previous, current)
+                t = trackers.OverlapAreaTracker(previous, strategy=strategy)
+                t.track(current)
+                print(
+                    "Overlap pairs tested:",
+                    strategy.tested,
+                    "of",
+                    len(previous) * len(current),
+                )
 
             # Save to output
-            outputter.output(current)
+            outputter.output(current, (period, timestamp))
 
             # Prepare next iteration
             previous = current
+            previous_time = timestamp
 
+    except OutputError:
+        # Systems were lost, the database can't be resumed from here
+        raise
     except Exception as e:
         print("Unexpected error:", e, sys.exc_info()[0])
+        if strict:
+            raise
+
+
+def create_outputter(database, columns, queuesize, batchsize):
+    """
+    This function creates the systems outputter: write-behind if queuesize
+    > 0, or direct writes otherwise.
+    """
+    if queuesize > 0:
+        return BackgroundOutputter(
+            database, "systems", columns, queuesize, batchsize
+        )
+    return Outputter(database, "systems", columns)
+
+
+def track_shard(periods, database, columns, queuesize, batchsize, *args):
+    """This function tracks the periods of a shard into its own database."""
+    if os.path.exists(database):
+        print("Removing previous shard database", database)
+        os.remove(database)
+
+    outputter = create_outputter(database, columns, queuesize, batchsize)
+    for period in periods:
+        track(period, *args, outputter, strict=True)
+
+    # Flush queued systems
+    outputter.close()
+
+
+def watch(
+    catalog,
+    repository,
+    database,
+    columns,
+    begin,
+    timeout,
+    interval,
+    areaoverlap,
+    *args
+):
+    """
+    This function tracks each new image of the repository as soon as it is
+    cataloged, keeping the previous systems in memory. A checkpoint is
+    recorded after each image is written, so a restart resumes right after
+    it. Unreadable images (e.g. still being written) are retried at the
+    next polls, up to RETRIES times, before being skipped.
+    """
+    # Last image written: last checkpoint or, for older databases, last
+    # systems. Systems written after the last checkpoint are discarded
+    conn = connect(database)
+    timestamp = discard_unchecked(conn, columns)
+    conn.close()
+
+    outputter = Outputter(database, "systems", columns)
+
+    # Previous systems, if any. Without them, images from begin (or all
+    # cataloged images) are tracked
+    previous = None
+    last = None
+    if timestamp is not None:
+        print("Resuming after", timestamp)
+        last = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+        loader = spatialite.Loader(database, "systems")
+        previous = loader.loadByDate("%Y-%m-%d %H:%M:%S", timestamp, [])
+    previous_time = last
+    period = last
+
+    # Create overlap area strategy, prefiltered by bounding boxes
+    strategy = overlap.IndexedOverlapStrategy(
+        trackers.RelativeOverlapAreaStrategy(areaoverlap)
+    )
+
+    # Failed attempts of each image
+    failures = collections.Counter()
+
+    while True:
+        catalog_g16.update(catalog, repository)
+        if last is not None:
+            after = last + datetime.timedelta(seconds=1)
+        else:
+            after = begin
+        images = catalog_g16.query(catalog, after, None, "C13")
+        if not images:
+            time.sleep(interval)
+            continue
+
+        for path, timestamp in images:
+            try:
+                current = detect(path, *args)
+            except Exception as e:
+                failures[path] += 1
+                if failures[path] < RETRIES:
+                    print("* Retrying image later:", path, e)
+                    break
+                print("* Skipping unreadable image:", path, e)
+                del failures[path]
+                last = timestamp
+                continue
+
+            # Start a new period after gaps greater than timeout
+            if (
+                previous_time is None
+                or (timestamp - previous_time).total_seconds() > timeout * 60
+            ):
+                if previous is not None:
+                    print("Gap greater than timeout, new period at", timestamp)
+                previous = None
+                period = timestamp
+
+            if previous is not None:
+                # Let's track!
+                strategy.index(previous, current)
+                t = trackers.OverlapAreaTracker(previous, strategy=strategy)
+                t.track(current)
+
+            # Save to output, then move past this image
+            outputter.output(current, (period, timestamp))
+            last = timestamp
+
+            # Prepare next image
+            previous = current
+            previous_time = timestamp
+        else:
+            continue
+
+        # Wait before retrying a failed image
+        time.sleep(interval)
 
 
 def main():
@@ -240,9 +549,7 @@ def main():
     group.add_argument(
         "-db", "--database", help="Path to an existing database", type=str
     )
-    parser.add_argument(
-        "-e", "--end", help="End date (yyyymmdd)", type=str, required=True
-    )
+    parser.add_argument("-e", "--end", help="End date (yyyymmdd)", type=str)
     parser.add_argument(
         "-c",
         "--config",
@@ -250,7 +557,25 @@ def main():
         type=str,
         required=True,
     )
+    parser.add_argument(
+        "--shard",
+        help="Track only the given shard (e.g. one per machine)",
+        type=int,
+    )
+    parser.add_argument(
+        "--merge",
+        help="Only merge the databases of previously tracked shards",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        help="Track new images as they arrive in the repository",
+        action="store_true",
+    )
     args = parser.parse_args()
+    if args.end is None and not args.watch:
+        parser.error("the following arguments are required: -e/--end")
 
     # Read config file and extract infos
     config = configparser.ConfigParser()
@@ -262,6 +587,13 @@ def main():
     # Get resolution
     resolution = float(config.get("Grid", "resolution"))
 
+    # Get remapping lookup tables directory
+    lutdir = config.get("Grid", "lutdir")
+
+    # Get cache of remapped grids (disabled if empty)
+    cachedir = config.get("Grid", "cachedir", fallback="")
+    cachesize = config.getint("Grid", "cachesize", fallback=2048)
+
     # Get tracking parameters
     repository = config.get("TrackingParameters", "repository")
     timeout = float(config.get("TrackingParameters", "timeout"))
@@ -269,14 +601,26 @@ def main():
     minarea = float(config.get("TrackingParameters", "minarea"))
     areaoverlap = float(config.get("TrackingParameters", "areaoverlap"))
     stats = [i for i in config.get("TrackingParameters", "stats").split(",")]
+    detector = config.get("TrackingParameters", "detector")
 
     # Get tracking parameters related with convective cells
     compute_cc = config.getboolean("TrackingParameters", "compute_cc")
     threshold_cc = float(config.get("TrackingParameters", "threshold_cc"))
     minarea_cc = float(config.get("TrackingParameters", "minarea_cc"))
 
-    # Last systems detected
+    # Get processing parameters
+    workers = config.getint("Processing", "workers")
+    prefetch = config.getint("Processing", "prefetch")
+    shards = config.getint("Processing", "shards")
+    interval = config.getfloat("Processing", "interval")
+
+    # Get output parameters
+    queuesize = config.getint("Output", "queuesize")
+    batchsize = config.getint("Output", "batchsize")
+
+    # Last systems detected (and their timestamp)
     current = None
+    current_time = None
 
     # Columns
     columns = stats.copy()
@@ -292,26 +636,76 @@ def main():
             + "-"
             + start
             + "-"
-            + args.end
+            + (args.end or "watch")
             + ".sqlite"
         )
         database = outputdir + dbname
+    elif args.watch:
+        database = args.database
+        start = None
     else:
         database = args.database
-        # Retrieve last date from the given existing database
-        db = spatialite.Loader(database, "systems")
-        # Get last date
-        start = datetime.datetime.strptime(db.getLastDate(), "%Y%m%d")
-        start = start + datetime.timedelta(days=1)
-        start = start.strftime("%Y%m%d")
+        # Retrieve the last image written to the given existing database:
+        # last checkpoint or, for older databases, last systems. Systems
+        # written after the last checkpoint are discarded
+        conn = connect(database)
+        timestamp = discard_unchecked(conn, columns)
+        conn.close()
+        if timestamp is None:
+            print("* Tracking exit: No systems found in", database)
+            exit(1)
+        print("Resuming after", timestamp)
+        current_time = datetime.datetime.strptime(
+            timestamp, "%Y-%m-%d %H:%M:%S"
+        )
+        start = current_time.strftime("%Y%m%d")
         # Load last systems
-        current = db.loadLastSystems(columns)
+        db = spatialite.Loader(database, "systems")
+        current = db.loadByDate("%Y-%m-%d %H:%M:%S", timestamp, [])
+
+    # Update the catalog of images (new files only)
+    catalog = catalog_g16.connect(config.get("TrackingParameters", "catalog"))
+    print("Updating catalog of images", repository)
+    catalog_g16.update(catalog, repository)
+
+    if args.watch:
+        print("== Tathu - Tracking and Analysis of Thunderstorms ==")
+        print(":: Watching repository of images:", repository)
+        print(":: Database:", database)
+        print(":: Polling interval:", interval, "seconds")
+        watch(
+            catalog,
+            repository,
+            database,
+            columns,
+            get_datetime(start) if start else None,
+            timeout,
+            interval,
+            areaoverlap,
+            extent,
+            resolution,
+            threshold,
+            minarea / (KM_PER_DEGREE * KM_PER_DEGREE),
+            stats,
+            compute_cc,
+            threshold_cc,
+            minarea_cc / (KM_PER_DEGREE * KM_PER_DEGREE),
+            lutdir,
+            detector,
+            cachedir,
+            cachesize,
+        )
+        return
 
     # Get all requested days
     days = get_days(start, args.end)
 
-    # Get files
-    files = get_files(repository, days)
+    # Get files (after the last image, if resuming)
+    begin = get_datetime(start)
+    if current_time is not None:
+        begin = current_time + datetime.timedelta(seconds=1)
+    end = get_datetime(args.end) + datetime.timedelta(days=1)
+    files = catalog_g16.get_files(catalog, begin, end, "C13")
 
     # Print infos
     print("== Tathu - Tracking and Analysis of Thunderstorms ==")
@@ -331,9 +725,12 @@ def main():
     print(":: Area Overlap:", areaoverlap * 100, "%")
     print(":: Compute convective cells?", compute_cc)
     print(":: Stats:", stats)
+    print(":: Detector:", detector)
     if compute_cc:
         print(":: CC temperature threshold:", threshold_cc, "Kelvin")
         print(":: Minimum area of CC:", minarea_cc, "km2")
+    print(":: Detection workers:", workers)
+    print(":: Time shards:", shards)
     print("== Tracking Info ==")
     print(":: Number of days:", len(days))
     print(":: Number of images found:", len(files))
@@ -347,12 +744,69 @@ def main():
     minarea_cc = minarea_cc / (KM_PER_DEGREE * KM_PER_DEGREE)
 
     # Extracting periods
-    periods = extract_periods(files, timeout)
+    periods = catalog_g16.get_periods(catalog, begin, end, "C13", timeout)
+    print(":: Number of periods:", len(periods))
+
+    # Sharded tracking (new databases only)
+    if shards > 1 and current is None:
+        plan = split_shards(periods, shards)
+        paths = [get_shard_name(database, k) for k in range(len(plan))]
+
+        if args.shard is None and os.path.exists(database):
+            print("* Tracking exit: Database already exists", database)
+            exit(1)
+
+        if not args.merge:
+            if args.shard is None:
+                indexes = list(range(len(plan)))
+            else:
+                indexes = [args.shard]
+            # One process per shard
+            with ProcessPoolExecutor(max_workers=len(indexes)) as pool:
+                futures = [
+                    pool.submit(
+                        track_shard,
+                        plan[k][0],
+                        paths[k],
+                        columns,
+                        queuesize,
+                        batchsize,
+                        extent,
+                        resolution,
+                        threshold,
+                        minarea,
+                        stats,
+                        compute_cc,
+                        threshold_cc,
+                        minarea_cc,
+                        lutdir,
+                        detector,
+                        cachedir,
+                        cachesize,
+                        areaoverlap,
+                        timeout,
+                    )
+                    for k in indexes
+                ]
+                for future in futures:
+                    future.result()
+
+        if args.shard is None:
+            # Timestamps of overlap images
+            overlaps = [
+                catalog_g16.get_timestamp(chunk[0][0])
+                if overlapped
+                else None
+                for chunk, overlapped in plan
+            ]
+            merge_shards(paths, overlaps, database, stats=columns)
+
+        return
 
     # Create database connection
-    db = spatialite.Outputter(database, "systems", columns)
+    db = create_outputter(database, columns, queuesize, batchsize)
 
-    # Tracking
+    # Tracking. Only the first period continues the last systems
     for period in periods:
         track(
             period,
@@ -364,10 +818,23 @@ def main():
             compute_cc,
             threshold_cc,
             minarea_cc,
+            lutdir,
+            detector,
+            cachedir,
+            cachesize,
             areaoverlap,
+            timeout,
             db,
             current,
+            current_time,
+            workers,
+            prefetch,
         )
+        current = None
+        current_time = None
+
+    # Flush queued systems
+    db.close()
 
 
 if __name__ == "__main__":
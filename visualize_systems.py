@@ -3,13 +3,13 @@
 # Adapted from tathu/examples/tracking-analysis/visualize-centroids.py
 #%%
 
-import pickle
-
 import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
 import shapely.wkt
 
+from patch_store import PatchStore
+
 
 # All centroids plot
 # Read dataset
@@ -30,23 +30,22 @@ import shapely.wkt
 # plt.clf()
 
 # Mask example
-with open("data/imgs_mask.pickle", "rb") as input:
-    imgs_mask = pickle.load(input)
-with open("data/imgs_nomask.pickle", "rb") as input:
-    imgs_nomask = pickle.load(input)
-with open("data/imgs_random.pickle", "rb") as input:
-    imgs_random = pickle.load(input)
-# with open("data/imgs_band.pickle", "rb") as input:
-#     imgs_band = pickle.load(input)
-# with open("data/imgs_random_band.pickle", "rb") as input:
-#     imgs_random_band = pickle.load(input)
+# Stores written by mask_systems.py/get_random_g16_samples.py
+systems = PatchStore("data/systems")
+random = PatchStore("data/random")
+# Decoded to float32 (see patch_store.py)
+imgs_nomask = systems.decode([80])
+imgs_random = random.decode([400])
+# imgs_mask = systems.masked(range(len(systems)))
+# imgs_band = [row[3] for row in systems.metadata()]
+# imgs_random_band = [row[3] for row in random.metadata()]
 
 # print(imgs_random_band[400])
 
 fig, axs = plt.subplots(nrows=1, ncols=2)
-im = axs[0].imshow(imgs_nomask[80][0], cmap="Greys", vmin=90, vmax=320, aspect=1)
-# im = axs[1].imshow(imgs_mask[80][0], cmap="Greys", vmin=90, vmax=320, aspect=1)
-im = axs[1].imshow(imgs_random[400][2], cmap="Greys", vmin=90, vmax=320, aspect=1)
+im = axs[0].imshow(imgs_nomask[0], cmap="Greys", vmin=90, vmax=320, aspect=1)
+# im = axs[1].imshow(imgs_mask[80], cmap="Greys", vmin=90, vmax=320, aspect=1)
+im = axs[1].imshow(imgs_random[0], cmap="Greys", vmin=90, vmax=320, aspect=1)
 # fig.subplots_adjust(right=0.85)
 # cbar_ax = fig.add_axes([0.9, 0.15, 0.05, 0.7])
 fig.colorbar(im, ax=axs.ravel().tolist(), aspect=7, shrink=0.55)